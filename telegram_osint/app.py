@@ -1,22 +1,25 @@
 import os
 import sys
 import json
-from time import time
-from flask import Flask, render_template, redirect, url_for, request
+import time
+import threading
+import multiprocessing
+from datetime import datetime, timedelta, timezone
+from markupsafe import Markup, escape
+from flask import Flask, Response, render_template, redirect, url_for, request, abort, send_file, jsonify, g
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
 sys.path.append(os.path.join(os.path.dirname(__file__), "src"))
 
-from analysis.activity import analyze_hourly_activity
-from analysis.days import analyze_weekday_activity
-from analysis.keywords import analyze_keywords
-from analysis.interactions import analyze_mentions, analyze_replies
+import metrics
+import renderer
+import warehouse
+from storage import chat_name, message_files, user_folders
+from result_cache import cached_artifact
+from analysis.charts import NGRAM_NAMES
 
-from user_tools import (
-    fetch_user_by_username,
-    fetch_user_by_phone,
-    fetch_user_messages_from_chat,
-    fetch_user_messages_from_multiple_chats
-)
+# The analysis queries (numpy) and Telegram jobs (Telethon) are imported by
+# the first request that needs them, so the app starts without either.
 
 app = Flask(
     __name__,
@@ -25,11 +28,61 @@ app = Flask(
 )
 
 DATA_DIR = "data"
+# The renderer pool is warmed up as soon as the app serves: when it is
+# imported by a WSGI server or `flask run`, or in the serving process of
+# `python app.py` (the debug reloader's parent only watches files), but
+# never in the renderer processes themselves, which import the main module
+# again. RENDER_PREWARM=0 leaves it to the first chart, for scripts that only
+# import the app.
+RENDER_PREWARM = os.getenv("RENDER_PREWARM", "1") not in ("", "0")
+
+_jobs = None
+_jobs_lock = threading.Lock()
+
+
+def job_manager():
+    # Created on first use so the debug reloader's parent process never
+    # starts (or resumes) jobs of its own.
+    global _jobs
+    with _jobs_lock:
+        if _jobs is None:
+            from jobs import JobManager
+            _jobs = JobManager(os.path.join(app.instance_path, "jobs.json"))
+    return _jobs
+
+
+@app.before_request
+def _start_timer():
+    g.started = time.perf_counter()
+
+
+@app.after_request
+def _record_request(response):
+    if "started" in g:
+        metrics.observe("http_request_seconds", time.perf_counter() - g.started,
+                        endpoint=request.endpoint or "none", status=response.status_code)
+    return response
+
+
+@app.route("/metrics")
+def metrics_endpoint():
+    """Counters and timers of this process in the Prometheus text format."""
+    return Response(metrics.render_prometheus(), mimetype="text/plain; version=0.0.4")
+
+
+def _tz_arg():
+    tz = request.args.get("tz") or None
+    if tz:
+        try:
+            ZoneInfo(tz)
+        except (ZoneInfoNotFoundError, ValueError):
+            abort(400, f"Unknown timezone: {tz}")
+    return tz
 
 
 @app.route("/")
 def index():
-    users = [f for f in os.listdir(DATA_DIR) if os.path.isdir(os.path.join(DATA_DIR, f))]
+    users = user_folders(DATA_DIR)
     return render_template("index.html", users=users)
 
 
@@ -44,78 +97,180 @@ def profile(username):
     return render_template("profile.html", username=username, profile=profile)
 
 
-@app.route("/activity/<username>")
-def activity(username):
+def _chats(username):
     folder = os.path.join(DATA_DIR, username)
-    fname = f"activity_{username}.png"
-    save_path = os.path.join(app.static_folder, fname)
-    analyze_hourly_activity(folder, save_path=save_path)
-    image_url = url_for("static", filename=fname) + f"?v={int(time())}"
+    return [chat_name(path) for path in message_files(folder)]
+
+
+def _visualization(kind, api_kind, title, username, chart_args=None):
+    if not os.path.isdir(os.path.join(DATA_DIR, username)):
+        abort(404)
     return render_template(
         "visualization.html",
-        title="Hourly Activity Chart",
+        title=title,
         username=username,
-        image_url=image_url
+        kind=api_kind,
+        api_url=url_for("api", kind=api_kind, username=username),
+        image_url=url_for("chart", kind=kind, username=username, **(chart_args or {})),
+        chats=_chats(username),
+        args=request.args
     )
 
 
+@app.route("/activity/<username>")
+def activity(username):
+    return _visualization("activity", "hourly", "Hourly Activity Chart", username, {"tz": _tz_arg()})
+
+
 @app.route("/days/<username>")
 def days(username):
-    folder = os.path.join(DATA_DIR, username)
-    fname = f"days_{username}.png"
-    save_path = os.path.join(app.static_folder, fname)
-    analyze_weekday_activity(folder, save_path=save_path)
-    image_url = url_for("static", filename=fname) + f"?v={int(time())}"
-    return render_template(
-        "visualization.html",
-        title="Weekly Activity Chart",
-        username=username,
-        image_url=image_url
-    )
+    return _visualization("days", "weekday", "Weekly Activity Chart", username, {"tz": _tz_arg()})
+
+
+def _ngram_arg():
+    n = request.args.get("n", 1, type=int)
+    if n not in NGRAM_NAMES:
+        abort(400, "n must be 1, 2 or 3")
+    return n
 
 
 @app.route("/keywords/<username>")
 def keywords(username):
-    folder = os.path.join(DATA_DIR, username)
-    fname = f"keywords_{username}.png"
-    save_path = os.path.join(app.static_folder, fname)
-    analyze_keywords(folder, save_path=save_path)
-    image_url = url_for("static", filename=fname) + f"?v={int(time())}"
-    return render_template(
-        "visualization.html",
-        title="Keyword Frequency",
-        username=username,
-        image_url=image_url
-    )
+    n = _ngram_arg()
+    return _visualization("keywords", "keywords", f"{NGRAM_NAMES[n]} Frequency", username,
+                          {"n": n if n > 1 else None})
 
 
 @app.route("/mentions/<username>")
 def mentions(username):
-    folder = os.path.join(DATA_DIR, username)
-    fname = f"mentions_{username}.png"
-    save_path = os.path.join(app.static_folder, fname)
-    analyze_mentions(folder, top_n=20, save_path=save_path)
-    image_url = url_for("static", filename=fname) + f"?v={int(time())}"
-    return render_template(
-        "visualization.html",
-        title="Top Mentions",
-        username=username,
-        image_url=image_url
-    )
+    return _visualization("mentions", "mentions", "Top Mentions", username)
 
 
 @app.route("/replies/<username>")
 def replies(username):
+    return _visualization("replies", "replies", "Reply Pairs", username)
+
+
+def _date_arg(name, days=0, tz=None):
+    """Epoch seconds of a YYYY-MM-DD (or ISO datetime) argument, read in tz or UTC."""
+    value = request.args.get(name) or None
+    if value is None:
+        return None
+    try:
+        date = datetime.fromisoformat(value)
+    except ValueError:
+        abort(400, f"Invalid date for {name}, expected YYYY-MM-DD")
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=ZoneInfo(tz) if tz else timezone.utc)
+    # A bare date shifted by `days` makes "to" include the whole day.
+    return int((date + timedelta(days=days if len(value) == 10 else 0)).timestamp())
+
+
+def _warehouse_db():
+    return os.path.join(DATA_DIR, "warehouse.db")
+
+
+API = {
+    "hourly": lambda queries, folder, window, args: queries.hourly(folder, **window, tz=args["tz"]),
+    "weekday": lambda queries, folder, window, args: queries.weekday(folder, **window, tz=args["tz"]),
+    "keywords": lambda queries, folder, window, args: queries.keywords(
+        folder, **window, ngram=args["n"], limit=args["limit"], db_path=_warehouse_db()),
+    "mentions": lambda queries, folder, window, args: queries.mentions(
+        folder, **window, limit=args["limit"], db_path=_warehouse_db()),
+    "replies": lambda queries, folder, window, args: queries.replies(
+        folder, **window, limit=args["limit"], db_path=_warehouse_db()),
+}
+
+
+@app.route("/api/<kind>/<username>")
+def api(kind, username):
+    """
+    JSON analytics for one user. Query parameters: from / to (dates,
+    inclusive, in tz), chat (repeatable), tz, n (1-3, keywords) and limit.
+    """
     folder = os.path.join(DATA_DIR, username)
-    fname = f"replies_{username}.png"
-    save_path = os.path.join(app.static_folder, fname)
-    analyze_replies(folder, top_n=15, save_path=save_path)
-    image_url = url_for("static", filename=fname) + f"?v={int(time())}"
+    if kind not in API or not os.path.isdir(folder):
+        abort(404)
+    tz = _tz_arg()
+    chats = [c.strip().lstrip("@") for value in request.args.getlist("chat") for c in value.split(",") if c.strip()]
+    window = {
+        "since": _date_arg("from", tz=tz),
+        "until": _date_arg("to", days=1, tz=tz),
+        "chats": chats or None,
+    }
+    args = {"tz": tz, "n": _ngram_arg(), "limit": max(1, min(request.args.get("limit", 20, type=int), 500))}
+    from analysis import queries
+    result = API[kind](queries, folder, window, args)
+    result.update({"kind": kind, "user": username, "from": request.args.get("from"),
+                   "to": request.args.get("to"), "chats": chats})
+    response = jsonify(result)
+    response.cache_control.no_cache = True
+    return response
+
+
+def _chart_args(kind):
+    if kind in ("activity", "days"):
+        return {"tz": _tz_arg()}
+    if kind == "keywords":
+        return {"n": _ngram_arg()}
+    return {}
+
+
+@app.route("/chart/<kind>/<username>.png")
+def chart(kind, username):
+    folder = os.path.join(DATA_DIR, username)
+    if kind not in renderer.CHART_KINDS or not os.path.isdir(folder):
+        abort(404)
+    args = _chart_args(kind)
+    path, etag, last_modified = cached_artifact(
+        kind, folder, args,
+        lambda save_path: renderer.render(kind, folder, save_path, args),
+        cache_dir=os.path.join(app.instance_path, "cache")
+    )
+    if path is None:
+        abort(404)
+    response = send_file(path, mimetype="image/png", etag=etag, last_modified=last_modified, conditional=True)
+    response.cache_control.no_cache = True
+    return response
+
+
+def _highlight(snippet):
+    return Markup(escape(snippet).replace("\x02", Markup("<mark>")).replace("\x03", Markup("</mark>")))
+
+
+@app.route("/search")
+def search():
+    query = request.args.get("q", "").strip()
+    target = request.args.get("user") or None
+    chat = request.args.get("chat", "").strip().lstrip("@") or None
+    sender = request.args.get("sender", "").strip() or None
+    if sender is not None and not sender.isdigit():
+        abort(400, "sender must be a numeric user id")
+    page = request.args.get("page", 1, type=int)
+
+    users = user_folders(DATA_DIR)
+    if target is not None and target not in users:
+        abort(404)
+
+    total, results = 0, []
+    if query:
+        db_path = _warehouse_db()
+        # Cheap when nothing changed: only the dumps' sizes are checked.
+        for name in [target] if target else users:
+            warehouse.ingest_folder(os.path.join(DATA_DIR, name), db_path)
+        total, results = warehouse.search(
+            query, target=target, chats=[chat] if chat else None, sender=sender,
+            since=_date_arg("from"), until=_date_arg("to", days=1),
+            page=page, marks=("\x02", "\x03"), db_path=db_path
+        )
+        for r in results:
+            r["snippet"] = _highlight(r["snippet"])
+            r["date"] = datetime.fromtimestamp(r["date"], timezone.utc).strftime("%Y-%m-%d %H:%M") if r["date"] else "—"
+
+    pages = (total + warehouse.SEARCH_PAGE_SIZE - 1) // warehouse.SEARCH_PAGE_SIZE
     return render_template(
-        "visualization.html",
-        title="Reply Pairs",
-        username=username,
-        image_url=image_url
+        "message_search.html", users=users, args=request.args,
+        results=results, total=total, page=page, pages=pages
     )
 
 
@@ -127,23 +282,26 @@ def tools():
 @app.route("/search_by_username", methods=["POST"])
 def search_by_username():
     username = request.form["username"].strip()
-    fetch_user_by_username(username)
-    return redirect(url_for("profile", username=username))
+    job_id = job_manager().submit("search_username", username=username)
+    return redirect(url_for("job", job_id=job_id))
 
 
 @app.route("/search_by_phone", methods=["POST"])
 def search_by_phone():
     phone = request.form["phone"].strip()
-    fetch_user_by_phone(phone)
-    return redirect("/")
+    job_id = job_manager().submit("search_phone", phone=phone)
+    return redirect(url_for("job", job_id=job_id))
 
 
 @app.route("/collect_single_chat", methods=["POST"])
 def collect_single_chat():
     user_username = request.form["user_username"].strip()
     chat_username = request.form["chat_username"].strip()
-    fetch_user_messages_from_chat(user_username, chat_username)
-    return redirect(url_for("profile", username=user_username))
+    incremental = "full" not in request.form
+    job_id = job_manager().submit(
+        "collect", user_username=user_username, chat_usernames=[chat_username], incremental=incremental
+    )
+    return redirect(url_for("job", job_id=job_id))
 
 
 @app.route("/collect_multiple_chats", methods=["POST"])
@@ -151,9 +309,43 @@ def collect_multiple_chats():
     user_username = request.form["user_username"].strip()
     raw = request.form["chat_usernames"].strip()
     chat_usernames = [s.strip() for s in raw.split(",") if s.strip()]
-    fetch_user_messages_from_multiple_chats(user_username, chat_usernames)
-    return redirect(url_for("profile", username=user_username))
+    incremental = "full" not in request.form
+    job_id = job_manager().submit(
+        "collect", user_username=user_username, chat_usernames=chat_usernames, incremental=incremental
+    )
+    return redirect(url_for("job", job_id=job_id))
+
+
+@app.route("/jobs")
+def jobs():
+    return render_template("jobs.html", jobs=job_manager().list())
+
+
+@app.route("/jobs/<job_id>")
+def job(job_id):
+    job = job_manager().get(job_id)
+    if job is None:
+        abort(404)
+    return render_template("job.html", job=job)
+
+
+@app.route("/jobs/<job_id>/status")
+def job_status(job_id):
+    job = job_manager().get(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job)
+
+
+@app.route("/jobs/<job_id>/cancel", methods=["POST"])
+def cancel_job(job_id):
+    job_manager().cancel(job_id)
+    return redirect(url_for("job", job_id=job_id))
+
 
+if (RENDER_PREWARM and multiprocessing.current_process().name == "MainProcess"
+        and (__name__ != "__main__" or os.environ.get("WERKZEUG_RUN_MAIN") == "true")):
+    renderer.start()
 
 if __name__ == "__main__":
     app.run(debug=True)
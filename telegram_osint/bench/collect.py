@@ -0,0 +1,214 @@
+"""
+Collection benchmark against the offline ReplayClient (src/replay_client.py).
+
+Each scenario runs in a fresh process and an empty working directory. The
+target user's synthetic chats (see synth.py) are replayed with the given
+per-request latency, flood waits and disconnects, and collected with
+user_tools.collect_user_messages as a web job would. Reports messages/sec,
+peak RSS and what the client saw, then checks that every chat's dump,
+index and checkpoint in the shared chat store hold exactly the replayed
+messages, once after the run and once after the chats grow and an
+incremental run catches up.
+
+    clean    no faults
+    faults   flood waits and disconnects; retries resume from checkpoints
+    resume   retries disabled, so the first disconnect fails a chat;
+             a second run has to finish it from the checkpoints
+    shared   the same chats collected for --targets targets in a row;
+             requests and disk usage should stay those of one target
+
+Retry backoff is set to zero so that only the injected flood waits sleep,
+and chats are only skipped as fresh in the shared scenario.
+Runs offline; Telegram credentials are ignored.
+
+    python bench/collect.py --messages 200000 --chats 4
+    python bench/collect.py --latency 0.05 --flood-every 200 --disconnect-every 150
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+import resource
+import tempfile
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.append(os.path.join(ROOT, "src"))
+
+SCENARIOS = ["clean", "faults", "resume", "shared"]
+TARGET = "synthetic"
+# Share of each chat added before the incremental run.
+GROWTH = 0.1
+
+
+def _peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+def _disk_mb(folder):
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(folder) for f in files) / 1e6
+
+
+def check_chats(sizes, final_sizes, source, targets):
+    """
+    Chats whose dump, index or checkpoint differ from the first sizes[chat]
+    replayed messages, or that some target does not read from the store.
+    """
+    from storage import INDEX_ROW_BYTES, SHARED_DIR, chat_file, index_file, load_checkpoint, message_files, read_messages
+    folder = os.path.join("data", SHARED_DIR)
+    views = [message_files(os.path.join("data", target)) for target in targets]
+    bad = []
+    for chat, size in sizes.items():
+        path = chat_file(folder, chat)
+        expected = list(itertools.islice(source(chat, final_sizes[chat]), size))
+        checkpoint = load_checkpoint(folder, chat) or {}
+        rows = os.path.getsize(index_file(path)) // INDEX_ROW_BYTES if os.path.exists(index_file(path)) else -1
+        if (list(read_messages(path)) != expected or checkpoint.get("count") != size
+                or checkpoint.get("last_id") != size or rows != size
+                or any(path not in files for files in views)):
+            bad.append(chat)
+    return bad
+
+
+def run_scenario(scenario, messages, chats, targets, latency, flood_every, flood_seconds, disconnect_every,
+                 concurrency):
+    os.chdir(tempfile.mkdtemp(prefix="collect-"))
+    sys.path.append(BENCH_DIR)
+    import metrics
+    import tg_client
+    import user_tools
+    from replay_client import ReplayClient
+    from synth import TARGET_ID, synth_messages
+
+    user_tools.COLLECT_BACKOFF = 0
+    fresh_seconds, user_tools.CHAT_FRESH_SECONDS = user_tools.CHAT_FRESH_SECONDS, 0
+    names = [TARGET] + [f"{TARGET}{i}" for i in range(2, targets + 1)] if scenario == "shared" else [TARGET]
+    per_chat = messages // chats
+    sizes = {f"chat{i}": per_chat for i in range(chats)}
+    final_sizes = {chat: size + int(size * GROWTH) for chat, size in sizes.items()}
+
+    def source(chat, size):
+        # Generated at the final size, so growing a chat only appends.
+        return itertools.islice(synth_messages(final_sizes[chat], seed=int(chat[4:])), size)
+
+    replayed = {chat: (lambda chat=chat: source(chat, sizes[chat])) for chat in sizes}
+    users = [{"id": TARGET_ID + i, "username": name, "first_name": "Synthetic"} for i, name in enumerate(names)]
+    service = tg_client.get_service()
+    clients = []
+
+    def collect(target=TARGET, **faults):
+        def factory():
+            clients.append(ReplayClient(replayed, users, latency=latency, **faults))
+            return clients[-1]
+        service.use_client(factory)
+        return service.run(user_tools.collect_user_messages(target, list(sizes), concurrency=concurrency))[1]
+
+    faults = {"flood_every": flood_every, "flood_seconds": flood_seconds, "disconnect_every": disconnect_every}
+    start = time.perf_counter()
+    if scenario == "clean":
+        collect()
+    elif scenario == "faults":
+        collect(**faults)
+    elif scenario == "shared":
+        user_tools.CHAT_FRESH_SECONDS = fresh_seconds
+        for name in names:
+            collect(name)
+        user_tools.CHAT_FRESH_SECONDS = 0
+    else:
+        retries, user_tools.COLLECT_MAX_RETRIES = user_tools.COLLECT_MAX_RETRIES, 0
+        collect(disconnect_every=disconnect_every)
+        user_tools.COLLECT_MAX_RETRIES = retries
+        collect()
+    seconds = time.perf_counter() - start
+    # A failed chat reports 0 new messages; what ends up stored is checked below.
+    collected = sum(sizes.values())
+    bad = check_chats(sizes, final_sizes, source, names)
+    disk_mb = _disk_mb("data")
+
+    sizes.update(final_sizes)
+    grown = collect()
+    bad_grown = check_chats(sizes, final_sizes, source, names)
+    snap = metrics.snapshot()
+    return {
+        "scenario": scenario,
+        "targets": len(names),
+        "messages": collected,
+        "seconds": seconds,
+        "messages_per_second": collected / seconds if seconds else 0.0,
+        "peak_rss_mb": _peak_rss_mb(),
+        "disk_mb": disk_mb,
+        "requests": sum(c.requests for c in clients),
+        "floods": sum(c.floods for c in clients),
+        "disconnects": sum(c.disconnects for c in clients),
+        "retries": sum(v for (name, _), v in snap["counters"].items() if name == "collect_retries_total"),
+        "failed_chats": sum(v for (name, labels), v in snap["counters"].items()
+                            if name == "collect_chats_total" and ("outcome", "failed") in labels),
+        "complete": not bad,
+        "grown_messages": sum(grown.values()),
+        "grown_complete": not bad_grown and sum(grown.values()) == sum(f - per_chat for f in final_sizes.values()),
+    }
+
+
+def _offline_env():
+    env = dict(os.environ)
+    # Empty values win over .env, so nothing can reach Telegram.
+    for name in ("TG_API_ID", "TG_API_HASH", "API_ID", "API_HASH", "TG_SESSION", "TG_REPLAY"):
+        env[name] = ""
+    return env
+
+
+def _child(scenario, args):
+    params = {k: getattr(args, k) for k in ("messages", "chats", "targets", "latency", "flood_every",
+                                            "flood_seconds", "disconnect_every", "concurrency")}
+    proc = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--scenario", scenario, json.dumps(params)],
+        env=_offline_env(), capture_output=True, text=True
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"scenario {scenario} failed:\n{proc.stderr}")
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark collection against a replayed Telegram client")
+    parser.add_argument("--messages", type=int, default=100000, help="messages over all chats")
+    parser.add_argument("--chats", type=int, default=4)
+    parser.add_argument("--targets", type=int, default=3, help="targets sharing the chats in the shared scenario")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per history request")
+    parser.add_argument("--flood-every", type=int, default=250, help="history requests between flood waits")
+    parser.add_argument("--flood-seconds", type=int, default=1)
+    parser.add_argument("--disconnect-every", type=int, default=170, help="history requests between disconnects")
+    parser.add_argument("--scenarios", nargs="+", default=SCENARIOS, choices=SCENARIOS)
+    parser.add_argument("--out", help="write the results as JSON")
+    parser.add_argument("--scenario", help=argparse.SUPPRESS)
+    parser.add_argument("params", nargs="?", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.scenario:
+        print(json.dumps(run_scenario(args.scenario, **json.loads(args.params))))
+        return
+
+    results = []
+    print(f"{'scenario':<8} {'targets':>7} {'messages':>9} {'sec':>8} {'msg/s':>9} {'peak MB':>8} {'disk MB':>8} "
+          f"{'requests':>8} {'floods':>6} {'drops':>6} {'retries':>7} {'failed':>6}  check")
+    for scenario in args.scenarios:
+        r = _child(scenario, args)
+        results.append(r)
+        check = "ok" if r["complete"] and r["grown_complete"] else "MISMATCH"
+        print(f"{scenario:<8} {r['targets']:>7} {r['messages']:>9} {r['seconds']:>8.2f} "
+              f"{r['messages_per_second']:>9.0f} {r['peak_rss_mb']:>8.1f} {r['disk_mb']:>8.1f} "
+              f"{r['requests']:>8} {r['floods']:>6} {r['disconnects']:>6} "
+              f"{r['retries']:>7} {r['failed_chats']:>6}  {check}")
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump({"params": vars(args), "results": results}, f, indent=2)
+    sys.exit(0 if all(r["complete"] and r["grown_complete"] for r in results) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Startup check for the CLI and the web app.
+
+Imports cli.py and app.py in fresh interpreters where Telethon cannot be
+imported and no Telegram credentials are set. The check fails if an
+import is slower than its budget (best of REPEAT runs) or loads a module
+that must wait until it is first used. It then runs every offline
+analyzer on a small synthetic corpus under the same conditions. Exits
+non-zero on any failure.
+
+    python bench/imports.py
+    python bench/imports.py --budget-scale 2   # slower machines
+"""
+import os
+import sys
+import json
+import argparse
+import tempfile
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.append(os.path.join(ROOT, "src"))
+
+REPEAT = 5
+# Seconds for a bare import, measured inside the child interpreter.
+IMPORT_BUDGETS = {"cli": 0.10, "app": 0.40}
+# Loaded on first use only, never by importing an entry point.
+LAZY_MODULES = ["telethon", "tg_client", "user_tools", "jobs", "numpy", "matplotlib"]
+
+# Setting a sys.modules entry to None makes importing it raise ImportError,
+# as if the package were not installed.
+_IMPORT_CHILD = """
+import sys, time, json
+sys.modules["telethon"] = None
+sys.path[:0] = [{src!r}, {root!r}]
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{"seconds": seconds, "loaded": [m for m in {lazy!r} if sys.modules.get(m) is not None]}}))
+"""
+
+_ANALYSIS_CHILD = """
+import sys
+sys.modules["telethon"] = None
+sys.path[:0] = [{src!r}]
+from analysis.activity import analyze_hourly_activity
+from analysis.days import analyze_weekday_activity
+from analysis.keywords import analyze_keywords
+from analysis.interactions import analyze_mentions, analyze_replies
+folder, out = {folder!r}, {out!r}
+analyze_hourly_activity(folder, save_path=out + "/hourly.png")
+analyze_weekday_activity(folder, save_path=out + "/weekday.png")
+analyze_keywords(folder, save_path=out + "/keywords.png")
+analyze_keywords(folder, save_path=out + "/bigrams.png", ngram=2)
+analyze_mentions(folder, save_path=out + "/mentions.png")
+analyze_replies(folder, save_path=out + "/replies.png")
+"""
+
+
+def _offline_env():
+    env = dict(os.environ)
+    # Empty values win over .env, so nothing can reach Telegram.
+    for name in ("TG_API_ID", "TG_API_HASH", "API_ID", "API_HASH", "TG_SESSION"):
+        env[name] = ""
+    # Only the import itself is timed, not the renderer processes it starts.
+    env["RENDER_PREWARM"] = "0"
+    return env
+
+
+def _python(code, cwd):
+    return subprocess.run([sys.executable, "-c", code], cwd=cwd, env=_offline_env(),
+                          capture_output=True, text=True)
+
+
+def check_imports(budget_scale=1.0):
+    failures = []
+    for module, budget in IMPORT_BUDGETS.items():
+        code = _IMPORT_CHILD.format(src=os.path.join(ROOT, "src"), root=ROOT, module=module, lazy=LAZY_MODULES)
+        runs = []
+        for _ in range(REPEAT):
+            proc = _python(code, ROOT)
+            if proc.returncode != 0:
+                failures.append(f"import {module} failed:\n{proc.stderr}")
+                break
+            runs.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+        if not runs:
+            continue
+        best = min(r["seconds"] for r in runs)
+        loaded = sorted({m for r in runs for m in r["loaded"]})
+        print(f"import {module:<4} {best * 1000:7.1f} ms  (budget {budget * budget_scale * 1000:.0f} ms)"
+              f"{'  loaded: ' + ', '.join(loaded) if loaded else ''}")
+        if best > budget * budget_scale:
+            failures.append(f"import {module} took {best:.3f} sec, budget {budget * budget_scale:.3f} sec")
+        if loaded:
+            failures.append(f"import {module} loaded {', '.join(loaded)}")
+    return failures
+
+
+def check_offline_analysis():
+    from synth import generate_corpus
+    with tempfile.TemporaryDirectory() as workdir:
+        folder = os.path.join(workdir, "data", "synthetic")
+        out = os.path.join(workdir, "charts")
+        generate_corpus(folder, 2000, chats=2)
+        proc = _python(_ANALYSIS_CHILD.format(src=os.path.join(ROOT, "src"), folder=folder, out=out), workdir)
+        if proc.returncode != 0:
+            return [f"offline analysis failed:\n{proc.stderr}"]
+        missing = [name for name in ("hourly", "weekday", "keywords", "bigrams", "mentions", "replies")
+                   if not os.path.exists(os.path.join(out, f"{name}.png"))]
+        if missing:
+            return [f"offline analysis produced no chart for {', '.join(missing)}"]
+    print("offline analysis without Telethon: ok")
+    return []
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check import-time budgets and offline analysis")
+    parser.add_argument("--budget-scale", type=float, default=1.0, help="multiply every budget")
+    args = parser.parse_args()
+
+    failures = check_imports(args.budget_scale) + check_offline_analysis()
+    for failure in failures:
+        print(f"[!] {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+"""
+Benchmark harness for the analysis pipeline.
+
+Generates synthetic corpora of the requested sizes, then runs every stage
+(counting every dump into the per-chat aggregates, index build, each
+analyzer, all analyzers together, the Flask chart routes) in a fresh
+process and records wall time, time spent saving charts and peak RSS.
+Results are written as JSON so runs from different commits can be
+compared. Runs offline; Telegram credentials are ignored.
+
+    python bench/run.py --sizes 10000 100000 1000000
+    python bench/run.py --compare bench/results/old.json bench/results/new.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import resource
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.append(os.path.join(ROOT, "src"))
+
+STAGES = ["load", "index", "hourly", "weekday", "keywords", "mentions", "replies", "dashboard", "routes"]
+ANALYZERS = ["hourly", "weekday", "keywords", "mentions", "replies"]
+
+
+def _peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+def _timed_savefig():
+    """Wrap Figure.savefig to accumulate the time spent rendering charts in this process."""
+    import matplotlib
+    matplotlib.use("Agg")
+    from matplotlib.figure import Figure
+    spent = [0.0]
+    original = Figure.savefig
+
+    def savefig(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return original(*args, **kwargs)
+        finally:
+            spent[0] += time.perf_counter() - start
+    Figure.savefig = savefig
+    return spent
+
+
+def _run_analyzer(name, folder, out_dir):
+    from analysis.activity import analyze_hourly_activity
+    from analysis.days import analyze_weekday_activity
+    from analysis.keywords import analyze_keywords
+    from analysis.interactions import analyze_mentions, analyze_replies
+    save_path = os.path.join(out_dir, f"{name}.png")
+    if name == "hourly":
+        analyze_hourly_activity(folder, save_path=save_path)
+    elif name == "weekday":
+        analyze_weekday_activity(folder, save_path=save_path)
+    elif name == "keywords":
+        analyze_keywords(folder, save_path=save_path)
+    elif name == "mentions":
+        analyze_mentions(folder, save_path=save_path)
+    elif name == "replies":
+        analyze_replies(folder, save_path=save_path)
+
+
+def run_stage(stage, folder):
+    """Run one stage in this process and return its measurements."""
+    out_dir = os.path.join(os.path.dirname(folder), "charts")
+    os.makedirs(out_dir, exist_ok=True)
+    render = [0.0]
+    extra = {}
+    start = time.perf_counter()
+
+    if stage == "load":
+        # Cold: what the first analyzer of a new folder pays, and later ones skip.
+        import metrics
+        from analysis.aggregates import load_aggregates
+        load_aggregates(folder)
+        extra["messages"] = sum(v for (name, _), v in metrics.snapshot()["counters"].items()
+                                if name == "load_messages_total")
+    elif stage == "index":
+        from storage import build_index, message_files
+        for path in message_files(folder):
+            build_index(path)
+    elif stage in ANALYZERS:
+        render = _timed_savefig()
+        _run_analyzer(stage, folder, out_dir)
+    elif stage == "dashboard":
+        render = _timed_savefig()
+        for name in ANALYZERS:
+            _run_analyzer(name, folder, out_dir)
+    elif stage == "routes":
+        # Charts are drawn in the renderer pool, which reports its render
+        # time back through metrics.
+        sys.path.append(ROOT)
+        import metrics
+        import app as webapp
+        webapp.DATA_DIR = os.path.dirname(folder)
+        webapp.app.instance_path = os.path.join(os.path.dirname(folder), "instance")
+        client = webapp.app.test_client()
+        user = os.path.basename(folder)
+        kinds = ["activity", "days", "keywords", "mentions", "replies"]
+        cold = time.perf_counter()
+        for kind in kinds:
+            assert client.get(f"/chart/{kind}/{user}.png").status_code == 200
+        extra["cold_seconds"] = time.perf_counter() - cold
+        warm = time.perf_counter()
+        for kind in kinds:
+            assert client.get(f"/chart/{kind}/{user}.png").status_code == 200
+        extra["warm_seconds"] = time.perf_counter() - warm
+        render[0] = sum(t[1] for (name, _), t in metrics.snapshot()["timers"].items() if name == "chart_seconds")
+    else:
+        raise ValueError(f"Unknown stage: {stage}")
+
+    return {
+        "seconds": time.perf_counter() - start,
+        "render_seconds": render[0],
+        "peak_rss_mb": _peak_rss_mb(),
+        **extra,
+    }
+
+
+def _offline_env():
+    env = dict(os.environ)
+    # Empty values win over .env, so nothing can reach Telegram.
+    for name in ("TG_API_ID", "TG_API_HASH", "API_ID", "API_HASH", "TG_SESSION"):
+        env[name] = ""
+    return env
+
+
+def _child(stage, folder, workdir):
+    proc = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--stage", stage, folder],
+        cwd=workdir, env=_offline_env(), capture_output=True, text=True
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"stage {stage} failed:\n{proc.stderr}")
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                              capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def benchmark(sizes, stages, workdir, chats, legacy, keep, compression=None):
+    from synth import generate_corpus
+    results = []
+    for size in sizes:
+        run_dir = os.path.join(workdir, f"n{size}")
+        shutil.rmtree(run_dir, ignore_errors=True)
+        folder = os.path.join(run_dir, "data", "synthetic")
+        start = time.perf_counter()
+        generate_corpus(folder, size, chats=chats, legacy=legacy, compression=compression)
+        print(f"[{size}] generated in {time.perf_counter() - start:.2f} sec.")
+        for stage in stages:
+            r = _child(stage, os.path.abspath(folder), run_dir)
+            r.update({"size": size, "stage": stage})
+            results.append(r)
+            print(f"[{size}] {stage:<10} {r['seconds']:8.3f} sec  render {r['render_seconds']:6.3f} sec  "
+                  f"peak {r['peak_rss_mb']:8.1f} MB")
+        if not keep:
+            shutil.rmtree(run_dir, ignore_errors=True)
+    return results
+
+
+def compare(old_path, new_path):
+    with open(old_path, encoding="utf-8") as f:
+        old = {(r["size"], r["stage"]): r for r in json.load(f)["results"]}
+    with open(new_path, encoding="utf-8") as f:
+        new = {(r["size"], r["stage"]): r for r in json.load(f)["results"]}
+    print(f"{'size':>9} {'stage':<10} {'old s':>9} {'new s':>9} {'x':>6} {'old MB':>8} {'new MB':>8}")
+    for key in sorted(old.keys() & new.keys()):
+        o, n = old[key], new[key]
+        speedup = o["seconds"] / n["seconds"] if n["seconds"] else float("inf")
+        print(f"{key[0]:>9} {key[1]:<10} {o['seconds']:9.3f} {n['seconds']:9.3f} {speedup:6.2f} "
+              f"{o['peak_rss_mb']:8.1f} {n['peak_rss_mb']:8.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the analysis pipeline on synthetic data")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--stages", nargs="+", default=STAGES, choices=STAGES)
+    parser.add_argument("--chats", type=int, default=4)
+    parser.add_argument("--legacy", action="store_true", help="generate indented .json dumps")
+    parser.add_argument("--plain", action="store_true", help="generate uncompressed .jsonl dumps")
+    parser.add_argument("--workdir", default=os.path.join(BENCH_DIR, "work"))
+    parser.add_argument("--out", help="results file (default bench/results/<commit>.json)")
+    parser.add_argument("--keep", action="store_true", help="keep generated corpora")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"))
+    parser.add_argument("--stage", help=argparse.SUPPRESS)
+    parser.add_argument("folder", nargs="?", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.stage:
+        print(json.dumps(run_stage(args.stage, args.folder)))
+        return
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    commit = _git_commit()
+    results = benchmark(args.sizes, args.stages, os.path.abspath(args.workdir), args.chats, args.legacy, args.keep,
+                        "none" if args.plain else None)
+    out = args.out or os.path.join(BENCH_DIR, "results", f"{commit or 'local'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump({
+            "commit": commit,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "results": results,
+        }, f, indent=4)
+    print(f"Results written to {out}")
+
+
+if __name__ == "__main__":
+    main()
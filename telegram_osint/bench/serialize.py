@@ -0,0 +1,98 @@
+"""
+Benchmark of the per-message serialization done while collecting.
+
+Builds Telethon Message objects from a synthetic corpus (see synth.py):
+forward headers, reply markup and formatting entities are mixed in, and
+message.text goes through the markdown parse mode the way it does with a
+real client. It then times user_tools._serialize_message followed by
+json.dumps, as MessageWriter does it, and reports CPU time and output
+size per message. With --src the serializer is imported from the src/
+folder of another checkout, so two commits can be compared on the same
+input. Runs offline.
+
+    python bench/serialize.py --messages 100000
+    python bench/serialize.py --src /path/to/old/checkout/telegram_osint/src
+"""
+import os
+import sys
+import json
+import time
+import inspect
+import argparse
+from types import ModuleType, SimpleNamespace
+from datetime import datetime, timezone
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+
+
+def build_messages(count, seed=0):
+    from telethon.extensions import markdown
+    from telethon.tl.custom.message import Message
+    from telethon.tl.types import (
+        MessageEntityBold, MessageEntityMention, MessageEntityMentionName, MessageFwdHeader, MessageReplyHeader,
+        PeerChannel, PeerUser, ReplyKeyboardHide
+    )
+    from synth import synth_messages
+
+    client = SimpleNamespace(parse_mode=markdown)
+    markup = ReplyKeyboardHide(selective=True)
+    messages = []
+    for i, rec in enumerate(synth_messages(count, seed=seed)):
+        date = datetime.fromtimestamp(rec["date"], timezone.utc)
+        entities = [MessageEntityMentionName(offset, length, *user) if kind == "mention_name"
+                    else MessageEntityMention(offset, length) for kind, offset, length, *user in rec["entities"] or ()]
+        if rec["text"] and i % 4 == 0:
+            entities.append(MessageEntityBold(0, min(5, len(rec["text"]))))
+        msg = Message(
+            id=rec["id"], peer_id=PeerChannel(1), date=date, message=rec["text"] or "",
+            from_id=PeerUser(rec["from_id"]),
+            reply_to=MessageReplyHeader(reply_to_msg_id=rec["reply_to_message_id"]) if rec["reply_to_message_id"] else None,
+            fwd_from=MessageFwdHeader(date=date, from_id=PeerChannel(2), channel_post=i) if i % 20 == 0 else None,
+            reply_markup=markup if i % 50 == 0 else None,
+            entities=entities or None,
+        )
+        msg._client = client
+        messages.append(msg)
+    return messages
+
+
+def measure(serialize, messages, **kwargs):
+    for msg in messages:
+        # message.text is computed once and cached on the object.
+        msg._text = None
+    start = time.process_time()
+    size = 0
+    for msg in messages:
+        size += len(json.dumps(serialize(msg, **kwargs), ensure_ascii=False).encode("utf-8")) + 1
+    seconds = time.process_time() - start
+    return {"us_per_message": seconds / len(messages) * 1e6, "bytes_per_message": size / len(messages)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark message serialization")
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--src", default=os.path.join(ROOT, "src"), help="src/ folder to import user_tools from")
+    args = parser.parse_args()
+
+    sys.path[:0] = [BENCH_DIR, os.path.abspath(args.src)]
+    # The storage module synth.py writes with comes from this checkout.
+    sys.path.append(os.path.join(ROOT, "src"))
+    # Older checkouts build a client from API_ID/API_HASH when tg_client is
+    # imported; the serializer never talks to Telegram, so it gets a stand-in.
+    tg_client = ModuleType("tg_client")
+    tg_client.client = tg_client.service = None
+    sys.modules["tg_client"] = tg_client
+    from user_tools import _serialize_message
+
+    messages = build_messages(args.messages)
+    modes = {"default": {}}
+    if "verbose" in inspect.signature(_serialize_message).parameters:
+        modes["verbose"] = {"verbose": True}
+    for name, kwargs in modes.items():
+        r = measure(_serialize_message, messages, **kwargs)
+        print(f"{name:<8} {r['us_per_message']:8.2f} us/message  {r['bytes_per_message']:8.1f} bytes/message")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""
+Synthetic chat corpus generator for benchmarks.
+
+Writes a user folder (profile.json + one dump per chat) whose messages
+follow the schema of user_tools._serialize_message, at any size, without
+touching Telegram.
+
+    python bench/synth.py data/synthetic --messages 1000000 --chats 8
+"""
+import os
+import sys
+import json
+import random
+import argparse
+from datetime import datetime, timezone
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from storage import MessageWriter, chat_file, index_file, legacy_chat_file
+
+TARGET_ID = 1
+
+WORDS = {
+    "ru": ("привет сегодня встреча город работа новости проект время деньги вопрос ответ друзья "
+           "канал группа вечером завтра думаю согласен конечно спасибо информация сообщение").split(),
+    "uk": ("привіт сьогодні зустріч місто робота новини проєкт час гроші питання відповідь друзі "
+           "канал група ввечері завтра думаю згоден звичайно дякую інформація повідомлення").split(),
+    "en": ("hello today meeting city work news project time money question answer friends channel "
+           "group evening tomorrow think agree course thanks information message release update").split(),
+}
+PUNCTUATION = ["", "", "", ",", ".", "!", "?", "…", "»"]
+EMOJI = ["👍", "🔥", "😂", "❤️", "🤔", "🇺🇦"]
+
+
+def _utf16_len(text):
+    return len(text.encode("utf-16-le")) // 2
+
+
+def _text(rng, users, mention_density):
+    words = WORDS[rng.choice(("ru", "ru", "uk", "en"))]
+    parts = [rng.choice(words) + rng.choice(PUNCTUATION) for _ in range(rng.randint(2, 14))]
+    if rng.random() < 0.15:
+        parts.insert(rng.randrange(len(parts) + 1), rng.choice(EMOJI))
+    if rng.random() < 0.05:
+        parts.append(str(rng.randint(1, 2030)))
+
+    text = " ".join(parts)
+    entities = None
+    if rng.random() < mention_density:
+        entities = []
+        for _ in range(rng.randint(1, 2)):
+            user = rng.randrange(users)
+            # Every tenth user has no username and is mentioned by name.
+            mention = f"User {user}" if user % 10 == 0 else f"@user{user}"
+            offset = _utf16_len(text) + 1
+            text = f"{text} {mention}"
+            entity = ["mention", offset, _utf16_len(mention)]
+            if user % 10 == 0:
+                entity = ["mention_name", offset, _utf16_len(mention), user + 2]
+            entities.append(entity)
+    return text, entities
+
+
+def synth_messages(count, users=500, reply_density=0.3, mention_density=0.05,
+                   start=datetime(2023, 1, 1, tzinfo=timezone.utc), days=365, seed=0):
+    """Yield `count` serialized messages with ascending ids and dates."""
+    rng = random.Random(seed)
+    t0 = start.timestamp()
+    step = days * 86400 / max(count, 1)
+    for i in range(1, count + 1):
+        # Roughly a tenth of the traffic comes from the target user.
+        uid = TARGET_ID if rng.random() < 0.1 else rng.randrange(2, users + 2)
+        text, entities = _text(rng, users, mention_density)
+        yield {
+            "id": i,
+            "date": int(t0 + i * step + rng.random() * step),
+            "edit_date": None,
+            "text": text if rng.random() > 0.05 else None,
+            "from_id": uid,
+            "reply_to_message_id": rng.randint(max(1, i - 500), i - 1) if i > 1 and rng.random() < reply_density else None,
+            "media_type": None,
+            "entities": entities,
+        }
+
+
+def _legacy_entity(kind, offset, length, user_id=None):
+    if kind == "mention_name":
+        return {"_": "MessageEntityMentionName", "offset": offset, "length": length, "user_id": user_id}
+    return {"_": "MessageEntityMention", "offset": offset, "length": length}
+
+
+def _legacy_record(msg):
+    """The same message in the schema of the old collector (ISO dates, TL dicts)."""
+    return {
+        **msg,
+        "date": datetime.fromtimestamp(msg["date"], timezone.utc).isoformat(),
+        "from_id": {"_": "PeerUser", "user_id": msg["from_id"]},
+        "fwd_from": None,
+        "entities": [_legacy_entity(*e) for e in msg["entities"]] if msg["entities"] else None,
+        "reply_markup": None,
+    }
+
+
+def write_legacy(path, messages):
+    """Write an indented JSON array like the pre-NDJSON collector, one message at a time."""
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("[")
+        for i, msg in enumerate(messages):
+            f.write(",\n    " if i else "\n    ")
+            f.write(json.dumps(_legacy_record(msg), indent=4, ensure_ascii=False).replace("\n", "\n    "))
+        f.write("\n]")
+
+
+def generate_corpus(folder, messages, chats=4, users=500, reply_density=0.3, mention_density=0.05,
+                    legacy=False, seed=0, compression=None):
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, "profile.json"), "w", encoding="utf-8") as f:
+        json.dump({"user_id": TARGET_ID, "first_name": "Synthetic", "last_name": "User",
+                   "username": os.path.basename(os.path.normpath(folder)), "phone": None,
+                   "bio": "", "status": "Last seen recently"}, f, indent=4, ensure_ascii=False)
+
+    per_chat = [messages // chats + (1 if i < messages % chats else 0) for i in range(chats)]
+    for i, count in enumerate(per_chat):
+        chat = f"synthetic_{i}"
+        stream = synth_messages(count, users, reply_density, mention_density, seed=seed * 1000 + i)
+        if legacy:
+            write_legacy(legacy_chat_file(folder, chat), stream)
+        else:
+            path = chat_file(folder, chat, compression)
+            with MessageWriter(path, index_path=index_file(path)) as writer:
+                for msg in stream:
+                    writer.write(msg)
+    return folder
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic user folder")
+    parser.add_argument("folder")
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--chats", type=int, default=4)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--reply-density", type=float, default=0.3)
+    parser.add_argument("--mention-density", type=float, default=0.05)
+    parser.add_argument("--legacy", action="store_true", help="write indented .json arrays")
+    parser.add_argument("--plain", action="store_true", help="write uncompressed .jsonl dumps")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    generate_corpus(args.folder, args.messages, args.chats, args.users, args.reply_density,
+                    args.mention_density, args.legacy, args.seed, "none" if args.plain else None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,405 @@
+import os
+import re
+import json
+import time
+import threading
+from array import array
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import metrics
+from storage import (
+    AGGREGATE_SUFFIX, INDEX_FIELDS, KEYWORDS_SUFFIX, chat_name, frame_offsets, index_record, is_compressed,
+    is_line_delimited, iter_new_lines, message_entities, message_files, read_messages, SKETCH_SUFFIX, state_file,
+    write_json_atomic
+)
+from analysis.message_index import load_index
+from analysis.topk import TopK
+
+# Per-chat partial counters, persisted next to the chat's checkpoint and
+# index. A .jsonl(.gz) dump is only read from the byte offset the counters
+# already cover, so refreshing after an incremental collection costs
+# O(new messages); the chats are merged when an analyzer asks for them.
+# The keyword counter and the n-gram sketches are kept in files of their own
+# and only read by the keyword analyzers, or when new data is counted.
+# Bump AGGREGATE_VERSION whenever what is counted changes.
+AGGREGATE_VERSION = 4
+
+# Message dates are bucketed by quarter hour: every UTC offset in use is a
+# multiple of 15 minutes, so hour and weekday histograms for any timezone
+# can be derived from the buckets exactly.
+BUCKET_SECONDS = 900
+
+# New data is counted in a process pool when there is enough of it; large
+# dumps are split into line-aligned chunks so one big chat uses every worker.
+ANALYSIS_WORKERS = int(os.getenv("ANALYSIS_WORKERS", os.cpu_count() or 1))
+CHUNK_BYTES = 16 * 1024 * 1024
+PARALLEL_MIN_BYTES = 8 * 1024 * 1024
+
+# Mentions come from the entity spans Telegram marks in every message. Only
+# dumps of the old collector, whose text is markdown-formatted so that the
+# offsets do not apply, are searched with MENTION_PATTERN instead.
+MENTION_PATTERN = re.compile(r"@[\w\d_]{4,}")
+
+# Words are runs of Unicode letters and digits, optionally joined by
+# hyphens or apostrophes ("из-за", "п'ять", "don't"). Punctuation of any
+# script, symbols and emoji never end up inside a token.
+TOKEN_PATTERN = re.compile(r"[^\W_]+(?:[-'][^\W_]+)*")
+
+# Stopword lists are plain files in analysis/stopwords, one word per line.
+STOPWORDS_DIR = os.path.join(os.path.dirname(__file__), "stopwords")
+KEYWORD_LANGUAGES = [lang.strip() for lang in os.getenv("KEYWORD_LANGUAGES", "ru,uk,en").split(",") if lang.strip()]
+
+# Bigrams and trigrams have too many distinct values to count exactly, so
+# only their approximate top is kept (see analysis.topk). The sketches are
+# fed a batch of NGRAM_BATCH messages at a time.
+NGRAM_ORDERS = (2, 3)
+NGRAM_BATCH = 2000
+
+
+def load_stopwords(languages):
+    words = set()
+    for lang in languages:
+        with open(os.path.join(STOPWORDS_DIR, f"{lang}.txt"), encoding="utf-8") as f:
+            words.update(line.strip() for line in f if line.strip())
+    return frozenset(words)
+
+
+STOPWORDS = load_stopwords(KEYWORD_LANGUAGES)
+
+
+def keyword_tokens(text, stopwords=STOPWORDS):
+    words = TOKEN_PATTERN.findall(text.lower().replace("’", "'"))
+    return [w for w in words if len(w) > 2 and not w.isdigit() and w not in stopwords]
+
+
+def ngrams(tokens, n):
+    return [" ".join(tokens[i:i + n]) for i in range(len(tokens) - n + 1)]
+
+
+def _utf16_span(text, offset, length):
+    if text.isascii():
+        return text[offset:offset + length]
+    return text.encode("utf-16-le")[2 * offset:2 * (offset + length)].decode("utf-16-le", "replace")
+
+
+def message_mentions(msg):
+    """
+    Who a serialized message mentions: "@username" strings, and user ids
+    for mentions by name. Entity offsets are in UTF-16 code units.
+    """
+    text, entities = msg.get("text"), msg.get("entities")
+    if isinstance(msg.get("date"), int) and not (entities and isinstance(entities[0], dict)):
+        if not entities:
+            return []
+        mentions = []
+        for kind, offset, length, *extra in entities:
+            if kind == "mention_name" and extra:
+                mentions.append(extra[0])
+            elif kind == "mention" and isinstance(text, str):
+                mentions.append(_utf16_span(text, offset, length))
+        return mentions
+
+    mentions = MENTION_PATTERN.findall(text) if isinstance(text, str) else []
+    for kind, _, _, *extra in message_entities(msg):
+        if kind == "mention_name" and extra:
+            mentions.append(extra[0])
+    return mentions
+
+
+def aggregate_file(path):
+    return state_file(os.path.dirname(path), chat_name(path), AGGREGATE_SUFFIX)
+
+
+def sketch_file(path):
+    return state_file(os.path.dirname(path), chat_name(path), SKETCH_SUFFIX)
+
+
+def keywords_file(path):
+    return state_file(os.path.dirname(path), chat_name(path), KEYWORDS_SUFFIX)
+
+
+def _empty(path):
+    return {
+        "version": AGGREGATE_VERSION,
+        "file": os.path.basename(path),
+        "languages": KEYWORD_LANGUAGES,
+        "bytes": 0,
+        "size": None,
+        "mtime_ns": None,
+        "last_id": 0,
+        "ascending": True,
+        "buckets": Counter(),
+        "keywords": Counter(),
+        # "sender:@username" or "sender:user id" -> mentions, and
+        # "sender:parent sender" -> replies.
+        "mentions": Counter(),
+        "replies": Counter(),
+        "topk": {n: TopK() for n in NGRAM_ORDERS},
+    }
+
+
+def _load(path, text=False):
+    """
+    The chat's aggregates if they are current, else None. Without `text`
+    the keyword counter and n-gram sketches are left out.
+    """
+    agg_path = aggregate_file(path)
+    if not os.path.exists(agg_path):
+        return None
+    try:
+        with open(agg_path, encoding="utf-8") as f:
+            agg = json.load(f)
+    except ValueError:
+        return None
+    if (agg.get("version") != AGGREGATE_VERSION or agg.get("file") != os.path.basename(path)
+            or agg.get("languages") != KEYWORD_LANGUAGES):
+        return None
+    for field in ("buckets", "mentions", "replies"):
+        agg[field] = Counter(agg[field])
+    keyword_total, totals = agg.pop("keyword_total"), agg.pop("ngram_totals")
+    if not text:
+        return agg
+
+    # The keywords and sketches are written before the JSON; totals that
+    # disagree mean the files are from different runs.
+    try:
+        with open(keywords_file(path), encoding="utf-8") as f:
+            words = json.load(f)
+        tables = np.load(sketch_file(path))
+    except (OSError, ValueError):
+        return None
+    agg["keywords"] = Counter(words["keywords"])
+    agg["topk"] = {n: TopK(table=tables[i], candidates=words["ngrams"][str(n)]) for i, n in enumerate(NGRAM_ORDERS)}
+    if sum(agg["keywords"].values()) != keyword_total or [agg["topk"][n].total for n in NGRAM_ORDERS] != totals:
+        return None
+    return agg
+
+
+def _save(path, agg):
+    tables = np.stack([agg["topk"][n].table for n in NGRAM_ORDERS])
+    tmp = f"{sketch_file(path)}.{os.getpid()}.{threading.get_ident()}.tmp"
+    os.makedirs(os.path.dirname(tmp), exist_ok=True)
+    with open(tmp, "wb") as f:
+        np.save(f, tables)
+    os.replace(tmp, sketch_file(path))
+    write_json_atomic(keywords_file(path), {
+        "keywords": agg["keywords"],
+        "ngrams": {str(n): list(agg["topk"][n].candidates) for n in NGRAM_ORDERS},
+    })
+
+    data = {k: v for k, v in agg.items() if k not in ("keywords", "topk")}
+    data["keyword_total"] = sum(agg["keywords"].values())
+    data["ngram_totals"] = [agg["topk"][n].total for n in NGRAM_ORDERS]
+    write_json_atomic(aggregate_file(path), data)
+
+
+def _count_replies(agg, path, rows):
+    """Count (sender, parent sender) pairs of the new rows; parents are looked up in the chat's index."""
+    rows = np.frombuffer(rows, dtype=np.int64).reshape(-1, len(INDEX_FIELDS))
+    replies = rows[(rows[:, 3] > 0) & (rows[:, 1] > 0)]
+
+    new_ids = rows[:, 2]
+    if len(new_ids):
+        agg["ascending"] = bool(
+            agg["ascending"] and new_ids[0] > agg["last_id"] and np.all(np.diff(new_ids) > 0)
+        )
+        agg["last_id"] = int(max(agg["last_id"], new_ids.max()))
+    if not len(replies):
+        return
+
+    index = load_index(path)
+    ids, senders = index["id"], index["sender"]
+    if not agg["ascending"]:
+        order = np.argsort(ids, kind="stable")
+        ids, senders = ids[order], senders[order]
+    # The last message with a given id wins, like a dict built over the dump.
+    pos = np.searchsorted(ids, replies[:, 3], side="right") - 1
+    found = (pos >= 0) & (ids[np.maximum(pos, 0)] == replies[:, 3])
+    parents = np.where(found, senders[np.maximum(pos, 0)], 0)
+    for uid_from, uid_to in zip(replies[:, 1].tolist(), parents.tolist()):
+        if uid_to and uid_from != uid_to:
+            agg["replies"][f"{uid_from}:{uid_to}"] += 1
+
+
+def _count(task):
+    """
+    Count the messages of one task: (path, start, end) over complete lines
+    of a .jsonl(.gz) dump, or (path, None, None) for a whole legacy dump. Runs
+    in worker processes, so it only returns partial counters.
+    """
+    began = time.perf_counter()
+    path, start, end = task
+    if start is None:
+        start = os.path.getsize(path)
+        stream = ((msg, start) for msg in read_messages(path))
+        # Legacy dumps are read from the start.
+        read_from = 0
+    else:
+        stream = iter_new_lines(path, start, end)
+        read_from = start
+
+    part = {
+        "buckets": Counter(), "keywords": Counter(), "mentions": Counter(),
+        "topk": {n: TopK() for n in NGRAM_ORDERS}, "rows": array("q"), "end": start,
+    }
+    batch = {n: Counter() for n in NGRAM_ORDERS}
+    for i, (msg, offset) in enumerate(stream, 1):
+        record = index_record(msg)
+        part["rows"].extend(record)
+        if record[0]:
+            part["buckets"][str(record[0] // BUCKET_SECONDS)] += 1
+        text = msg.get("text")
+        if isinstance(text, str):
+            tokens = keyword_tokens(text)
+            part["keywords"].update(tokens)
+            for n in NGRAM_ORDERS:
+                batch[n].update(ngrams(tokens, n))
+        if msg.get("entities") or not isinstance(msg.get("date"), int):
+            part["mentions"].update(f"{record[1]}:{mentioned}" for mentioned in message_mentions(msg))
+        if i % NGRAM_BATCH == 0:
+            for n in NGRAM_ORDERS:
+                part["topk"][n].update(batch[n])
+                batch[n].clear()
+        part["end"] = offset
+    for n in NGRAM_ORDERS:
+        part["topk"][n].update(batch[n])
+    # Measured here because this may run in a worker process; the parent
+    # records it in metrics.
+    part["bytes"] = part["end"] - read_from
+    part["seconds"] = time.perf_counter() - began
+    return part
+
+
+def _split(path, start, size, chunk_bytes):
+    """
+    Cut [start, size) of a .jsonl dump into line-aligned ranges of about
+    chunk_bytes; a compressed dump is cut at gzip member boundaries.
+    """
+    bounds = [start]
+    if is_compressed(path):
+        for offset in frame_offsets(path, start, size) or []:
+            if offset - bounds[-1] >= chunk_bytes:
+                bounds.append(offset)
+        bounds.append(None)
+        return list(zip(bounds[:-1], bounds[1:]))
+    with open(path, "rb") as f:
+        pos = start + chunk_bytes
+        while pos < size:
+            f.seek(pos)
+            f.readline()
+            pos = f.tell()
+            if pos >= size:
+                break
+            bounds.append(pos)
+            pos += chunk_bytes
+    bounds.append(None)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _plan(path, chunk_bytes, text=False):
+    """Return (aggregates, tasks still to count, stat) for one chat dump."""
+    st = os.stat(path)
+    agg = _load(path, text)
+    if agg and agg["size"] == st.st_size and agg["mtime_ns"] == st.st_mtime_ns:
+        return agg, [], st
+    if agg and not text:
+        # New data is merged into every counter, the text ones included.
+        agg = _load(path, text=True)
+    if not is_line_delimited(path):
+        # Legacy dumps are rewritten as a whole, never appended to.
+        return _empty(path), [(path, None, None)], st
+    if not agg or agg["bytes"] > st.st_size:
+        agg = _empty(path)
+    return agg, [(path, a, b) for a, b in _split(path, agg["bytes"], st.st_size, chunk_bytes)], st
+
+
+def _map(tasks, workers, work_bytes):
+    if workers > 1 and len(tasks) > 1 and work_bytes >= PARALLEL_MIN_BYTES:
+        with ProcessPoolExecutor(min(workers, len(tasks))) as pool:
+            return list(pool.map(_count, tasks))
+    return [_count(task) for task in tasks]
+
+
+def load_aggregates(user_folder, workers=None, chunk_bytes=CHUNK_BYTES, chats=None, text=False):
+    """
+    Bring the aggregates of every chat in the folder up to date and return
+    them. New data is counted per chat dump, or per chunk of a large one,
+    in up to `workers` processes (ANALYSIS_WORKERS by default); the
+    partial counters are merged in dump order, so the result does not
+    depend on the worker count. `chats` limits the result to those chats.
+    Chats that are already up to date come without "keywords" and "topk"
+    unless `text` is set.
+    """
+    workers = ANALYSIS_WORKERS if workers is None else workers
+    paths = [p for p in message_files(user_folder) if chats is None or chat_name(p) in chats]
+    plans = [(path, *_plan(path, chunk_bytes, text)) for path in paths]
+    tasks = [task for _, _, chat_tasks, _ in plans for task in chat_tasks]
+    work_bytes = sum(st.st_size - agg["bytes"] for _, agg, chat_tasks, st in plans if chat_tasks)
+    parts = iter(_map(tasks, workers, work_bytes))
+
+    result = []
+    for path, agg, chat_tasks, st in plans:
+        metrics.inc("aggregates_chats_total", state="updated" if chat_tasks else "fresh")
+        if chat_tasks:
+            rows = array("q")
+            for _ in chat_tasks:
+                part = next(parts)
+                metrics.inc("load_files_total")
+                metrics.inc("load_bytes_total", part["bytes"])
+                metrics.inc("load_messages_total", len(part["rows"]) // len(INDEX_FIELDS))
+                metrics.observe("load_seconds", part["seconds"])
+                for field in ("buckets", "keywords", "mentions"):
+                    agg[field].update(part[field])
+                for n in NGRAM_ORDERS:
+                    agg["topk"][n].merge(part["topk"][n])
+                rows.extend(part["rows"])
+                agg["bytes"] = part["end"]
+            _count_replies(agg, path, rows)
+            agg["size"], agg["mtime_ns"] = st.st_size, st.st_mtime_ns
+            _save(path, agg)
+        result.append(agg)
+    return result
+
+
+def merged_counter(user_folder, field, workers=None, chats=None):
+    """Sum one counter over all chats; ties keep first-seen order, as a single scan would."""
+    total = Counter()
+    for agg in load_aggregates(user_folder, workers, chats=chats, text=field == "keywords"):
+        total.update(agg[field])
+    return total
+
+
+def mention_counts(user_folder, workers=None, chats=None, sender=None):
+    """Counter of mentioned "@username"s and user ids, optionally of one sender's messages only."""
+    total = Counter()
+    for agg in load_aggregates(user_folder, workers, chats=chats):
+        for key, n in agg["mentions"].items():
+            uid, mentioned = key.split(":", 1)
+            if sender is None or int(uid) == sender:
+                total[mentioned if mentioned.startswith("@") else int(mentioned)] += n
+    return total
+
+
+def activity_buckets(user_folder, workers=None, chats=None):
+    """(bucket start epochs, message counts) over all chats of the folder."""
+    buckets = merged_counter(user_folder, "buckets", workers, chats)
+    starts = np.fromiter((int(k) * BUCKET_SECONDS for k in buckets), dtype=np.int64, count=len(buckets))
+    counts = np.fromiter(buckets.values(), dtype=np.int64, count=len(buckets))
+    return starts, counts
+
+
+def top_ngrams(user_folder, n, top_n=20, workers=None, chats=None):
+    """
+    Approximate [(n-gram, count)] of the folder, most frequent first.
+    Candidates of every chat are scored against every chat's sketch, so an
+    n-gram is counted in full wherever one chat kept it as a candidate.
+    """
+    topks = [agg["topk"][n] for agg in load_aggregates(user_folder, workers, chats=chats, text=True)]
+    items = list(dict.fromkeys(item for topk in topks for item in topk.candidates))
+    if not items:
+        return []
+    counts = sum(topk.estimate(items) for topk in topks)
+    return sorted(zip(items, counts.tolist()), key=lambda kv: (-kv[1], kv[0]))[:top_n]
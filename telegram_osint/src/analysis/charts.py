@@ -0,0 +1,69 @@
+import os
+
+import metrics
+
+# Charts are drawn on standalone Figure objects, never through pyplot's
+# global state, so several can be rendered at once. matplotlib is imported
+# on first use: importing an analyzer does not load it. Without a save_path
+# a chart is drawn through pyplot instead and shown in a window.
+
+# Chart and page titles for analysis.keywords' ngram sizes.
+NGRAM_NAMES = {1: "Keyword", 2: "Bigram", 3: "Trigram"}
+
+
+def _figure(save_path, width, height):
+    if save_path is None:
+        import matplotlib.pyplot as plt
+        return plt.figure(figsize=(width, height))
+    from matplotlib.figure import Figure
+    return Figure(figsize=(width, height))
+
+
+def _save(fig, save_path, tight_bbox):
+    if save_path is None:
+        import matplotlib.pyplot as plt
+        fig.tight_layout()
+        plt.show()
+        return
+    os.makedirs(os.path.dirname(save_path) or ".", exist_ok=True)
+    with metrics.span("chart_seconds"):
+        fig.tight_layout()
+        fig.savefig(save_path, bbox_inches="tight" if tight_bbox else None)
+
+
+def placeholder(save_path, text):
+    fig = _figure(save_path, 8, 4)
+    ax = fig.add_subplot()
+    ax.text(0.5, 0.5, text, ha="center", va="center")
+    ax.axis("off")
+    _save(fig, save_path, tight_bbox=True)
+
+
+def bar_chart(save_path, labels, values, title, xlabel, ylabel, color=None, rotation=0, ha="center",
+              xticks=None, grid=False, tight_bbox=False):
+    fig = _figure(save_path, 10, 5)
+    ax = fig.add_subplot()
+    ax.bar(labels, values, color=color)
+    if xticks is not None:
+        ax.set_xticks(xticks)
+    if rotation:
+        for label in ax.get_xticklabels():
+            label.set_rotation(rotation)
+            label.set_horizontalalignment(ha)
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
+    ax.set_title(title)
+    if grid:
+        ax.grid(axis="y", linestyle="--", alpha=0.6)
+    _save(fig, save_path, tight_bbox)
+
+
+def barh_chart(save_path, labels, values, title, xlabel="Count"):
+    fig = _figure(save_path, 10, max(3, 0.5 * len(labels) + 1))
+    ax = fig.add_subplot()
+    ax.barh(range(len(labels)), values)
+    ax.set_yticks(range(len(labels)), labels)
+    ax.set_xlabel(xlabel)
+    ax.set_title(title)
+    ax.invert_yaxis()
+    _save(fig, save_path, tight_bbox=True)
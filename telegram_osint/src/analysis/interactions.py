@@ -1,54 +1,39 @@
 import os
 import json
-import re
 from collections import Counter
-import matplotlib
-matplotlib.use("Agg")
-import matplotlib.pyplot as plt
-from telethon.tl.types import PeerUser
 
-import asyncio
-from telethon import TelegramClient
-from telethon.sessions import StringSession
+import numpy as np
 
-def analyze_mentions(user_folder, top_n=20, save_path="web/static/mentions.png"):
-    message_files = [f for f in os.listdir(user_folder) if f.startswith("messages_") and f.endswith(".json")]
+import entity_cache
+import metrics
+
+from analysis import charts
+from analysis.aggregates import mention_counts
+from analysis.reply_graph import load_reply_graph
+
+@metrics.timed("analyze_seconds", stage="mentions")
+def analyze_mentions(user_folder, top_n=20, save_path="web/static/mentions.png", workers=None):
+    """
+    Count who the messages mention, from the per-chat mention index.
+    Mentions by user id are counted under the user's "@username" when it
+    can be resolved, together with the mentions written with it.
+    """
+    counts = mention_counts(user_folder, workers)
+    usernames = _resolve_usernames(user_folder, [m for m in counts if isinstance(m, int)])
     mention_counter = Counter()
-    mention_pattern = re.compile(r"@[\w\d_]{4,}")
-    for file in message_files:
-        path = os.path.join(user_folder, file)
-        with open(path, encoding="utf-8") as f:
-            messages = json.load(f)
-            for msg in messages:
-                text = msg.get("text")
-                if not isinstance(text, str):
-                    continue
-                mentions = mention_pattern.findall(text)
-                mention_counter.update(mentions)
+    for mentioned, n in counts.items():
+        mention_counter[usernames.get(str(mentioned), str(mentioned))] += n
     out_path = os.path.join(user_folder, "mentions.json")
     with open(out_path, "w", encoding="utf-8") as f:
         json.dump(mention_counter.most_common(), f, indent=4, ensure_ascii=False)
 
     top_mentions = mention_counter.most_common(top_n)
-    os.makedirs(os.path.dirname(save_path), exist_ok=True)
     if not top_mentions:
-        plt.figure(figsize=(8, 4))
-        plt.text(0.5, 0.5, "No mentions found", ha="center", va="center")
-        plt.axis("off")
-        plt.savefig(save_path, bbox_inches="tight")
-        plt.close()
+        charts.placeholder(save_path, "No mentions found")
         return
 
     labels, counts = zip(*top_mentions)
-    plt.figure(figsize=(10, max(3, 0.5 * len(labels) + 1)))
-    plt.barh(range(len(labels)), counts)
-    plt.yticks(range(len(labels)), labels)
-    plt.xlabel("Count")
-    plt.title("Top mentions")
-    plt.gca().invert_yaxis()
-    plt.tight_layout()
-    plt.savefig(save_path, bbox_inches="tight")
-    plt.close()
+    charts.barh_chart(save_path, labels, counts, "Top mentions")
 
 def _load_user_map(user_folder):
     p = os.path.join(user_folder, "user_map.json")
@@ -57,143 +42,121 @@ def _load_user_map(user_folder):
             return json.load(f)
     return {}
 
-def _save_user_map(user_folder, mapping):
-    p = os.path.join(user_folder, "user_map.json")
-    with open(p, "w", encoding="utf-8") as f:
-        json.dump(mapping, f, indent=4, ensure_ascii=False)
-
-async def _resolve_usernames_async(ids):
-    api_id = os.getenv("TG_API_ID")
-    api_hash = os.getenv("TG_API_HASH")
-    session = os.getenv("TG_SESSION")
-    if not api_id or not api_hash:
-        return {}
-    sess = StringSession(session) if session else "osint_session"
-    async with TelegramClient(sess, int(api_id), api_hash) as client:
-        res = {}
-        for uid in ids:
-            try:
-                ent = await client.get_entity(int(uid))
-                uname = getattr(ent, "username", None)
-                if uname:
-                    res[str(uid)] = f"@{uname}"
-            except Exception:
-                pass
-        return res
-
 def _resolve_usernames(user_folder, ids):
-    cached = _load_user_map(user_folder)
-    missing = {str(i) for i in ids if str(i) not in cached}
-    found = {}
-    if missing:
-        try:
-            found = asyncio.run(_resolve_usernames_async(missing))
-        except Exception:
-            found = {}
-    merged = {**cached, **found}
-    if found:
-        _save_user_map(user_folder, merged)
-    return merged
-
-def analyze_replies(user_folder, top_n=10, save_path="web/static/replies.png"):
-    message_files = [f for f in os.listdir(user_folder) if f.startswith("messages_") and f.endswith(".json")]
-    reply_counter = Counter()
-    msg_id_to_user = {}
-    all_messages = []
-    id_to_name = {}
-
-    target_uid = None
-    target_username = None
+    """
+    Map user ids to "@username" through the shared entity cache. Entries of
+    a legacy per-folder user_map.json are reused for ids the cache does not
+    have yet. Nothing is looked up on Telegram here: the charts are drawn in
+    renderer processes, which must not open the Telegram session. Ids are
+    resolved when chats are collected (see referenced_ids), and the ones
+    still unknown are shown as numbers.
+    """
+    cached, missing = entity_cache.lookup(ids)
+    legacy = _load_user_map(user_folder)
+    seeded = {uid: legacy[str(uid)].lstrip("@") for uid in missing if str(uid) in legacy}
+    if seeded:
+        entity_cache.store(seeded, fetched=os.path.getmtime(os.path.join(user_folder, "user_map.json")))
+        cached.update(seeded)
+    return {str(uid): f"@{username}" for uid, username in cached.items() if username}
+
+def _profile(user_folder):
+    """(user id, "@username") of the folder's target, either may be None."""
     profile_path = os.path.join(user_folder, "profile.json")
-    if os.path.exists(profile_path):
-        with open(profile_path, encoding="utf-8") as f:
-            profile = json.load(f)
-            target_uid = profile.get("user_id")
-            name = f"{profile.get('first_name') or ''} {profile.get('last_name') or ''}".strip()
-            username = profile.get("username")
-            if target_uid is not None:
-                if username:
-                    target_username = f"@{username}"
-                if name:
-                    id_to_name[target_uid] = name
-                else:
-                    id_to_name[target_uid] = str(target_uid)
-
-    for file in message_files:
-        path = os.path.join(user_folder, file)
-        with open(path, encoding="utf-8") as f:
-            msgs = json.load(f)
-            all_messages.extend(msgs)
-            for msg in msgs:
-                mid = msg.get("id")
-                from_id = msg.get("from_id", {})
-                uid = from_id.get("user_id") if isinstance(from_id, dict) else None
-                if mid and uid:
-                    msg_id_to_user[mid] = uid
-
-    for msg in all_messages:
-        from_id = msg.get("from_id")
-        reply_id = msg.get("reply_to_message_id")
-        if isinstance(from_id, dict) and reply_id:
-            uid_from = from_id.get("user_id")
-            uid_to = msg_id_to_user.get(reply_id)
-            if uid_from and uid_to and uid_from != uid_to:
-                if target_uid is None or uid_from == target_uid or uid_to == target_uid:
-                    reply_counter[(uid_from, uid_to)] += 1
-
-    pairs_all = reply_counter.most_common()
-    ids_to_resolve = set()
-    for (u1, u2), _ in pairs_all:
-        if target_uid is None or u1 == target_uid or u2 == target_uid:
-            if target_uid is None or u1 != target_uid:
-                ids_to_resolve.add(u1)
-            if target_uid is None or u2 != target_uid:
-                ids_to_resolve.add(u2)
-    username_map = _resolve_usernames(user_folder, ids_to_resolve)
-
-    reply_data = [
-        {
-            "from": (target_username or str(k[0])) if (target_uid is not None and k[0] == target_uid) else username_map.get(str(k[0]), str(k[0])),
-            "to": (target_username or str(k[1])) if (target_uid is not None and k[1] == target_uid) else username_map.get(str(k[1]), str(k[1])),
-            "count": v
-        }
-        for k, v in pairs_all
-        if target_uid is None or k[0] == target_uid or k[1] == target_uid
-    ]
-    out_path = os.path.join(user_folder, "replies.json")
-    with open(out_path, "w", encoding="utf-8") as f:
+    if not os.path.exists(profile_path):
+        return None, None
+    with open(profile_path, encoding="utf-8") as f:
+        profile = json.load(f)
+    username = profile.get("username")
+    return profile.get("user_id"), f"@{username}" if username else None
+
+def _graph_summary(graph, target_uid, top_n=10, communities=5):
+    """Summary of the reply graph with user ids; _label_summary swaps in names."""
+    sent, received = graph.out_degree(), graph.in_degree()
+    degree = sent + received
+    rank = graph.pagerank()
+    community = graph.communities()
+    pairs_share, replies_share = graph.reciprocity()
+    target = graph.node(target_uid) if target_uid is not None else None
+    groups = []
+    for c in range(min(communities, len(set(community.tolist())))):
+        members = np.flatnonzero(community == c)
+        top = members[np.argsort(-degree[members], kind="stable")][:top_n]
+        groups.append({"size": len(members), "members": graph.users[top].tolist()})
+    return {
+        "users": len(graph),
+        "pairs": len(graph.weight),
+        "replies": int(graph.weight.sum()),
+        "reciprocity": {"pairs": round(pairs_share, 4), "replies": round(replies_share, 4)},
+        "chats": graph.chat_weights(),
+        "partners": [{"user": uid, "sent": s, "received": r}
+                     for uid, s, r in graph.partners(target_uid, top_n)] if target is not None else [],
+        "central": [{"user": int(graph.users[j]), "pagerank": round(float(rank[j]), 6),
+                     "sent": int(sent[j]), "received": int(received[j])}
+                    for j in np.argsort(-rank, kind="stable")[:top_n]],
+        "communities": groups,
+        "target_community": int(community[target]) if target is not None else None,
+    }
+
+def _summary_ids(summary):
+    ids = {p["user"] for p in summary["partners"]} | {c["user"] for c in summary["central"]}
+    return ids.union(*(g["members"] for g in summary["communities"]))
+
+def _label_summary(summary, label):
+    for item in summary["partners"] + summary["central"]:
+        item["user"] = label(item["user"])
+    for group in summary["communities"]:
+        group["members"] = [label(uid) for uid in group["members"]]
+    return summary
+
+def referenced_ids(user_folder, workers=None):
+    """User ids analyze_mentions and analyze_replies label, for collection to resolve ahead of them."""
+    target_uid, _ = _profile(user_folder)
+    graph = load_reply_graph(user_folder, workers)
+    ids = {uid for pair, _ in graph.pairs(target_uid) for uid in pair} | _summary_ids(_graph_summary(graph, target_uid))
+    ids.update(m for m in mention_counts(user_folder, workers) if isinstance(m, int))
+    ids.discard(target_uid)
+    return sorted(ids)
+
+@metrics.timed("analyze_seconds", stage="replies")
+def analyze_replies(user_folder, top_n=10, save_path="web/static/replies.png", workers=None):
+    """
+    Reply pairs involving the target user (every pair if the profile has
+    no user id), most frequent first, from the folder's reply graph: all
+    of them go to replies.json and the top_n to the chart. A summary of
+    the whole graph (reciprocity, the target's partners, the most central
+    users and the largest communities) goes to reply_graph.json.
+    """
+    target_uid, target_username = _profile(user_folder)
+    graph = load_reply_graph(user_folder, workers)
+    pairs = graph.pairs(target_uid)
+    summary = _graph_summary(graph, target_uid)
+
+    ids = {uid for pair, _ in pairs for uid in pair} | _summary_ids(summary)
+    ids.discard(target_uid)
+    username_map = _resolve_usernames(user_folder, ids)
+
+    def label(uid):
+        if target_uid is not None and uid == target_uid:
+            return target_username or str(uid)
+        return username_map.get(str(uid), str(uid))
+
+    reply_data = [{"from": label(a), "to": label(b), "count": n} for (a, b), n in pairs]
+    with open(os.path.join(user_folder, "replies.json"), "w", encoding="utf-8") as f:
         json.dump(reply_data, f, indent=4, ensure_ascii=False)
+    with open(os.path.join(user_folder, "reply_graph.json"), "w", encoding="utf-8") as f:
+        json.dump(_label_summary(summary, label), f, indent=4, ensure_ascii=False)
 
-    top_pairs = [
-        item for item in reply_counter.most_common(top_n)
-        if target_uid is None or item[0][0] == target_uid or item[0][1] == target_uid
-    ]
-    os.makedirs(os.path.dirname(save_path), exist_ok=True)
-    if not top_pairs:
-        plt.figure(figsize=(8, 4))
-        plt.text(0.5, 0.5, "No replies found", ha="center", va="center")
-        plt.axis("off")
-        plt.savefig(save_path, bbox_inches="tight")
-        plt.close()
+    if not pairs:
+        charts.placeholder(save_path, "No replies found")
         return
 
     labels = []
     counts = []
-    for (u1, u2), c in top_pairs:
-        l1 = (target_username or str(u1)) if (target_uid is not None and u1 == target_uid) else username_map.get(str(u1), str(u1))
-        l2 = (target_username or str(u2)) if (target_uid is not None and u2 == target_uid) else username_map.get(str(u2), str(u2))
-        lab = f"{l1} → {l2}"
+    for (u1, u2), c in pairs[:top_n]:
+        lab = f"{label(u1)} → {label(u2)}"
         if len(lab) > 48:
             lab = lab[:45] + "..."
         labels.append(lab)
         counts.append(c)
 
-    plt.figure(figsize=(10, max(3, 0.5 * len(labels) + 1)))
-    plt.barh(range(len(labels)), counts)
-    plt.yticks(range(len(labels)), labels)
-    plt.xlabel("Count")
-    plt.title("Top reply pairs")
-    plt.gca().invert_yaxis()
-    plt.tight_layout()
-    plt.savefig(save_path, bbox_inches="tight")
-    plt.close()
+    charts.barh_chart(save_path, labels, counts, "Top reply pairs")
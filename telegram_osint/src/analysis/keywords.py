@@ -1,51 +1,33 @@
 import os
 import json
-import string
-from collections import Counter
-import matplotlib
-matplotlib.use("Agg")
-import matplotlib.pyplot as plt
 
-try:
-    from nltk.corpus import stopwords
-    RUS_STOP = set(stopwords.words("russian"))
-except Exception:
-    RUS_STOP = set()
+import metrics
+from analysis import charts
+from analysis.aggregates import merged_counter, top_ngrams
+from analysis.charts import NGRAM_NAMES
 
-def analyze_keywords(user_folder, top_n=20, save_path="web/static/keywords.png"):
-    message_files = [f for f in os.listdir(user_folder) if f.startswith("messages_") and f.endswith(".json")]
-    all_words = []
-    translator = str.maketrans("", "", string.punctuation + "«»…“”")
 
-    for file in message_files:
-        path = os.path.join(user_folder, file)
-        with open(path, encoding="utf-8") as f:
-            messages = json.load(f)
-            for msg in messages:
-                text = msg.get("text")
-                if not isinstance(text, str):
-                    continue
-                text = text.lower().translate(translator)
-                words = text.split()
-                words = [w for w in words if w not in RUS_STOP and len(w) > 2 and not w.isdigit()]
-                all_words.extend(words)
-
-    counter = Counter(all_words)
-
-    out_path = os.path.join(user_folder, "keywords_top.json")
+@metrics.timed("analyze_seconds", stage="keywords")
+def analyze_keywords(user_folder, top_n=20, save_path="web/static/keywords.png", workers=None, ngram=1):
+    """
+    Most frequent words (ngram=1, exact counts) or word pairs / triples
+    (ngram=2 or 3, approximate counts from bounded-memory sketches).
+    """
+    if ngram == 1:
+        top_words = merged_counter(user_folder, "keywords", workers).most_common(top_n)
+        out_path = os.path.join(user_folder, "keywords_top.json")
+    else:
+        top_words = top_ngrams(user_folder, ngram, top_n, workers)
+        out_path = os.path.join(user_folder, f"keywords_top_{ngram}grams.json")
     with open(out_path, "w", encoding="utf-8") as f:
-        json.dump(counter.most_common(top_n), f, indent=4, ensure_ascii=False)
+        json.dump(top_words, f, indent=4, ensure_ascii=False)
 
-    top_words = counter.most_common(top_n)
-    if top_words:
-        words, counts = zip(*top_words)
-        plt.figure(figsize=(10, 5))
-        plt.bar(words, counts)
-        plt.xticks(rotation=45, ha="right")
-        plt.xlabel("Words")
-        plt.ylabel("Frequency")
-        plt.title("Keyword Frequency Analysis")
-        plt.tight_layout()
-        os.makedirs(os.path.dirname(save_path), exist_ok=True)
-        plt.savefig(save_path, bbox_inches="tight")
-        plt.close()
+    if not top_words:
+        charts.placeholder(save_path, "No keywords found")
+        return
+    words, counts = zip(*top_words)
+    charts.bar_chart(
+        save_path, words, counts, f"{NGRAM_NAMES[ngram]} Frequency Analysis",
+        xlabel="Words" if ngram == 1 else "Phrases", ylabel="Frequency",
+        rotation=45, ha="right", tight_bbox=True
+    )
@@ -0,0 +1,57 @@
+import os
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+import numpy as np
+
+from storage import INDEX_FIELDS, build_index, index_file, index_is_fresh
+
+INDEX_DTYPE = np.dtype([(name, np.int64) for name in INDEX_FIELDS])
+
+# 1970-01-01 was a Thursday; shifts epoch days so that Monday is 0.
+EPOCH_WEEKDAY = 3
+WEEKDAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+
+
+def load_index(path):
+    """
+    Memory-map the companion index of one chat dump as a structured array
+    with int64 fields date (epoch seconds), sender, id and reply_to.
+    The index is rebuilt first if it is missing or older than the dump.
+    """
+    if not index_is_fresh(path):
+        build_index(path)
+    index_path = index_file(path)
+    if os.path.getsize(index_path) == 0:
+        return np.zeros(0, dtype=INDEX_DTYPE)
+    return np.memmap(index_path, dtype=INDEX_DTYPE, mode="r")
+
+
+def to_local(dates, tz=None):
+    """
+    Shift epoch seconds to wall-clock seconds in `tz` (a zone name such as
+    "Europe/Kyiv"). UTC offsets are looked up once per distinct hour, not
+    per message, so DST changes are honoured at vectorized cost.
+    """
+    if tz is None or len(dates) == 0:
+        return dates
+    zone = ZoneInfo(tz) if isinstance(tz, str) else tz
+    hours, inverse = np.unique(dates // 3600, return_inverse=True)
+    offsets = np.array(
+        [datetime.fromtimestamp(int(h) * 3600, zone).utcoffset().total_seconds() for h in hours],
+        dtype=np.int64,
+    )
+    return dates + offsets[inverse.reshape(-1)]
+
+
+def _histogram(values, size, weights=None):
+    counts = np.bincount(values, weights=weights, minlength=size)
+    return counts.astype(np.int64) if weights is not None else counts
+
+
+def hour_histogram(dates, tz=None, weights=None):
+    return _histogram((to_local(dates, tz) // 3600) % 24, 24, weights)
+
+
+def weekday_histogram(dates, tz=None, weights=None):
+    return _histogram((to_local(dates, tz) // 86400 + EPOCH_WEEKDAY) % 7, 7, weights)
@@ -0,0 +1,130 @@
+"""
+JSON-ready analytics for the web API.
+
+Every function takes an optional time window (since/until, epoch seconds)
+and chat filter. Whole-history queries are answered from the per-chat
+aggregates; hourly and weekday counts come from their quarter-hour
+buckets even with a window. Keyword, mention and reply queries for a
+window are pushed to the warehouse, which is brought up to date first.
+"""
+import os
+import json
+from collections import Counter
+
+import numpy as np
+
+import entity_cache
+import warehouse
+from analysis.aggregates import (
+    MENTION_PATTERN, NGRAM_BATCH, activity_buckets, keyword_tokens, mention_counts, merged_counter, message_mentions,
+    ngrams, top_ngrams
+)
+from analysis.message_index import WEEKDAYS, hour_histogram, weekday_histogram
+from analysis.reply_graph import load_reply_graph
+from analysis.topk import TopK
+
+
+def _target(user_folder):
+    return os.path.basename(os.path.normpath(user_folder))
+
+
+def _windowed_buckets(user_folder, since, until, chats):
+    starts, counts = activity_buckets(user_folder, chats=chats)
+    mask = np.ones(len(starts), dtype=bool)
+    if since is not None:
+        mask &= starts >= since
+    if until is not None:
+        mask &= starts < until
+    return starts[mask], counts[mask]
+
+
+def hourly(user_folder, since=None, until=None, chats=None, tz=None):
+    starts, counts = _windowed_buckets(user_folder, since, until, chats)
+    return {"labels": list(range(24)), "counts": hour_histogram(starts, tz, counts).tolist(), "tz": tz or "UTC"}
+
+
+def weekday(user_folder, since=None, until=None, chats=None, tz=None):
+    starts, counts = _windowed_buckets(user_folder, since, until, chats)
+    return {"labels": WEEKDAYS, "counts": weekday_histogram(starts, tz, counts).tolist(), "tz": tz or "UTC"}
+
+
+def _texts(user_folder, since, until, chats, db_path):
+    warehouse.ingest_folder(user_folder, db_path)
+    return warehouse.message_texts(_target(user_folder), chats, since, until, db_path=db_path)
+
+
+def keywords(user_folder, since=None, until=None, chats=None, ngram=1, limit=20,
+             db_path=warehouse.WAREHOUSE_DB):
+    if since is None and until is None:
+        if ngram == 1:
+            items = merged_counter(user_folder, "keywords", chats=chats).most_common(limit)
+        else:
+            items = top_ngrams(user_folder, ngram, limit, chats=chats)
+        return {"items": items}
+
+    if ngram == 1:
+        counter = Counter()
+        for text in _texts(user_folder, since, until, chats, db_path):
+            counter.update(keyword_tokens(text))
+        return {"items": counter.most_common(limit)}
+
+    topk, batch = TopK(), Counter()
+    for i, text in enumerate(_texts(user_folder, since, until, chats, db_path), 1):
+        batch.update(ngrams(keyword_tokens(text), ngram))
+        if i % NGRAM_BATCH == 0:
+            topk.update(batch)
+            batch.clear()
+    topk.update(batch)
+    return {"items": topk.top(limit)}
+
+
+def mentions(user_folder, since=None, until=None, chats=None, limit=20, db_path=warehouse.WAREHOUSE_DB):
+    """
+    Most mentioned users. Mentions by user id are merged under the
+    username the entity cache knows for them, or shown as the number.
+    """
+    if since is None and until is None:
+        counts = mention_counts(user_folder, chats=chats)
+    else:
+        warehouse.ingest_folder(user_folder, db_path)
+        counts = Counter()
+        for msg in warehouse.message_entities(_target(user_folder), chats, since, until, db_path=db_path):
+            # Text-only rows of legacy dumps: their mentions are found in the text.
+            counts.update(message_mentions(msg) if msg["entities"] else MENTION_PATTERN.findall(msg["text"]))
+    names, _ = entity_cache.lookup({m for m in counts if isinstance(m, int)})
+    counter = Counter()
+    for mentioned, n in counts.items():
+        counter[f"@{names[mentioned]}" if names.get(mentioned) else str(mentioned)] += n
+    return {"items": counter.most_common(limit)}
+
+
+def _profile(user_folder):
+    path = os.path.join(user_folder, "profile.json")
+    if not os.path.exists(path):
+        return None, None
+    with open(path, encoding="utf-8") as f:
+        profile = json.load(f)
+    return profile.get("user_id"), profile.get("username")
+
+
+def replies(user_folder, since=None, until=None, chats=None, limit=20, db_path=warehouse.WAREHOUSE_DB):
+    """
+    Reply pairs involving the target user. Names come from the entity
+    cache only; ids it does not know yet are shown as numbers rather than
+    looked up on Telegram during the request.
+    """
+    target_uid, target_username = _profile(user_folder)
+    if since is None and until is None:
+        pairs = load_reply_graph(user_folder, chats=chats).pairs(target_uid)
+    else:
+        warehouse.ingest_folder(user_folder, db_path)
+        pairs = warehouse.reply_pairs(_target(user_folder), target_uid, chats, since, until, db_path)
+    pairs = [(pair, n) for pair, n in pairs if target_uid is None or target_uid in pair][:limit]
+
+    names, _ = entity_cache.lookup({uid for pair, _ in pairs for uid in pair})
+    if target_uid is not None and target_username:
+        names[target_uid] = target_username
+
+    def label(uid):
+        return f"@{names[uid]}" if names.get(uid) else str(uid)
+    return {"items": [{"from": label(a), "to": label(b), "count": n} for (a, b), n in pairs]}
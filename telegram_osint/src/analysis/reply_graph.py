@@ -0,0 +1,173 @@
+import numpy as np
+
+from storage import chat_name
+from analysis.aggregates import load_aggregates
+
+# PageRank settings; the iteration stops early once the L1 change is below
+# PAGERANK_TOL.
+PAGERANK_DAMPING = 0.85
+PAGERANK_MAX_ITER = 100
+PAGERANK_TOL = 1e-9
+# Label propagation rounds; every round updates half of the users.
+COMMUNITY_MAX_ITER = 40
+
+
+class ReplyGraph:
+    """
+    Who replies to whom, as a directed weighted graph: an edge u -> v of
+    weight w means u replied to v w times. The per-chat edges are kept as
+    parallel integer arrays (src, dst, chat, weight) with users numbered
+    0..n-1 (`users` holds their ids); edges merged across chats are
+    stored as CSR adjacency sorted by source, plus its transpose.
+    Edge order is remembered, so ties come out in the order the pairs
+    were first seen, as with Counter.most_common.
+    """
+
+    def __init__(self, src, dst, weight, chat=None, chats=()):
+        src, dst = np.asarray(src, dtype=np.int64), np.asarray(dst, dtype=np.int64)
+        self.chats = list(chats)
+        self.users, nodes = np.unique(np.concatenate([src, dst]), return_inverse=True)
+        n = len(self.users)
+        self.edge_src, self.edge_dst = nodes[:len(src)], nodes[len(src):]
+        self.edge_weight = np.asarray(weight, dtype=np.int64)
+        self.edge_chat = np.zeros(len(src), dtype=np.int32) if chat is None else np.asarray(chat, dtype=np.int32)
+
+        keys, first, inverse = np.unique(self.edge_src * n + self.edge_dst, return_index=True, return_inverse=True)
+        self.src, self.dst = keys // n, keys % n
+        self.weight = np.bincount(inverse, weights=self.edge_weight, minlength=len(keys)).astype(np.int64)
+        self.first = first
+        self.indptr = np.concatenate([[0], np.cumsum(np.bincount(self.src, minlength=n))])
+        order = np.lexsort((self.src, self.dst))
+        self.in_edges = order
+        self.in_indptr = np.concatenate([[0], np.cumsum(np.bincount(self.dst, minlength=n))])
+
+    def __len__(self):
+        return len(self.users)
+
+    def node(self, user_id):
+        """Index of a user id, or None if the user is not in the graph."""
+        i = int(np.searchsorted(self.users, user_id))
+        return i if i < len(self.users) and self.users[i] == user_id else None
+
+    def pairs(self, user_id=None):
+        """[((from id, to id), replies)] most frequent first, optionally only pairs involving user_id."""
+        idx = np.arange(len(self.weight))
+        if user_id is not None:
+            i = self.node(user_id)
+            if i is None:
+                return []
+            idx = idx[(self.src == i) | (self.dst == i)]
+        idx = idx[np.lexsort((self.first[idx], -self.weight[idx]))]
+        return [((a, b), n) for a, b, n in zip(self.users[self.src[idx]].tolist(),
+                                               self.users[self.dst[idx]].tolist(), self.weight[idx].tolist())]
+
+    def out_degree(self):
+        """Replies sent by each user (weighted out-degree)."""
+        return np.bincount(self.src, weights=self.weight, minlength=len(self)).astype(np.int64)
+
+    def in_degree(self):
+        """Replies received by each user (weighted in-degree)."""
+        return np.bincount(self.dst, weights=self.weight, minlength=len(self)).astype(np.int64)
+
+    def partners(self, user_id, k=10):
+        """[(partner id, replies to them, replies from them)] of the k partners with most replies both ways."""
+        i = self.node(user_id)
+        if i is None:
+            return []
+        out = slice(self.indptr[i], self.indptr[i + 1])
+        inc = self.in_edges[self.in_indptr[i]:self.in_indptr[i + 1]]
+        sent = np.bincount(self.dst[out], weights=self.weight[out], minlength=len(self))
+        received = np.bincount(self.src[inc], weights=self.weight[inc], minlength=len(self))
+        total = sent + received
+        nodes = np.flatnonzero(total)
+        nodes = nodes[np.argsort(-total[nodes], kind="stable")][:k]
+        return [(int(self.users[j]), int(sent[j]), int(received[j])) for j in nodes]
+
+    def reciprocity(self):
+        """
+        (share of pairs answered in the other direction too, share of
+        replies that are matched by a reply back). Both are 0 for an
+        empty graph.
+        """
+        if not len(self.weight):
+            return 0.0, 0.0
+        n = len(self)
+        keys = self.src * n + self.dst
+        reverse = self.dst * n + self.src
+        pos = np.minimum(np.searchsorted(keys, reverse), len(keys) - 1)
+        mutual = keys[pos] == reverse
+        back = np.where(mutual, self.weight[pos], 0)
+        return float(mutual.mean()), float(np.minimum(self.weight, back).sum() / self.weight.sum())
+
+    def pagerank(self, damping=PAGERANK_DAMPING, max_iter=PAGERANK_MAX_ITER, tol=PAGERANK_TOL):
+        """PageRank of every user over reply weights: being replied to by central users counts most."""
+        n = len(self)
+        if not n:
+            return np.zeros(0)
+        out = self.out_degree()
+        share = self.weight / out[self.src]
+        dangling = out == 0
+        rank = np.full(n, 1.0 / n)
+        for _ in range(max_iter):
+            new = np.bincount(self.dst, weights=rank[self.src] * share, minlength=n)
+            new = damping * (new + rank[dangling].sum() / n) + (1 - damping) / n
+            if np.abs(new - rank).sum() < tol:
+                return new
+            rank = new
+        return rank
+
+    def communities(self, max_iter=COMMUNITY_MAX_ITER):
+        """
+        Community number of every user by label propagation over the
+        undirected reply weights; communities are numbered by size,
+        largest first. Deterministic: ties go to the smaller label, a
+        user keeps its label when nothing beats it, and even and odd
+        users are updated in alternate rounds so labels cannot swap back
+        and forth forever.
+        """
+        n = len(self)
+        if not n:
+            return np.zeros(0, dtype=np.int64)
+        nodes = np.arange(n)
+        u = np.concatenate([self.src, self.dst, nodes])
+        v = np.concatenate([self.dst, self.src, nodes])
+        w = np.concatenate([self.weight, self.weight, np.full(n, 0.5)])
+        labels = nodes.copy()
+        stable = 0
+        for it in range(max_iter):
+            votes, inverse = np.unique(u * n + labels[v], return_inverse=True)
+            score = np.bincount(inverse, weights=w)
+            node, label = votes // n, votes % n
+            # The user's own vote of 0.5 makes its current label win ties.
+            order = np.lexsort((label, -score, node))
+            best = order[np.concatenate([[True], node[order][1:] != node[order][:-1]])]
+            new = labels.copy()
+            turn = nodes % 2 == it % 2
+            new[turn] = label[best][turn]
+            stable = stable + 1 if np.array_equal(new, labels) else 0
+            labels = new
+            if stable == 2:
+                break
+        _, inverse, sizes = np.unique(labels, return_inverse=True, return_counts=True)
+        rank = np.empty(len(sizes), dtype=np.int64)
+        rank[np.lexsort((np.arange(len(sizes)), -sizes))] = np.arange(len(sizes))
+        return rank[inverse.reshape(-1)]
+
+    def chat_weights(self):
+        """{chat: replies} over the per-chat edges."""
+        totals = np.bincount(self.edge_chat, weights=self.edge_weight, minlength=len(self.chats)).astype(np.int64)
+        return dict(zip(self.chats, totals.tolist()))
+
+
+def load_reply_graph(user_folder, workers=None, chats=None):
+    """Reply graph of a user folder, from the per-chat reply counters of analysis.aggregates."""
+    src, dst, weight, chat, names = [], [], [], [], []
+    for i, agg in enumerate(load_aggregates(user_folder, workers, chats=chats)):
+        names.append(chat_name(agg["file"]))
+        for key, n in agg["replies"].items():
+            a, b = key.split(":")
+            src.append(int(a))
+            dst.append(int(b))
+            weight.append(n)
+            chat.append(i)
+    return ReplyGraph(src, dst, weight, chat, names)
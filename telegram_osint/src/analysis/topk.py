@@ -0,0 +1,80 @@
+import hashlib
+
+import numpy as np
+
+# A count-min sketch of SKETCH_DEPTH x SKETCH_WIDTH uint32 counters (512 KB)
+# overestimates an item by at most ~e / SKETCH_WIDTH of the stream total
+# with high probability, however many distinct items the stream has.
+SKETCH_WIDTH = 1 << 15
+SKETCH_DEPTH = 4
+TOPK_CAPACITY = 1000
+
+
+def _hashes(items):
+    return np.fromiter(
+        (int.from_bytes(hashlib.blake2b(item.encode("utf-8"), digest_size=8).digest(), "little") for item in items),
+        dtype=np.uint64, count=len(items),
+    )
+
+
+class TopK:
+    """
+    Approximate most frequent items of a stream in bounded memory. Counts
+    go into a count-min sketch; the `capacity` items with the highest
+    estimates are kept as candidates, the rest are forgotten. Updates take
+    a Counter of a batch of the stream.
+    """
+
+    def __init__(self, capacity=TOPK_CAPACITY, table=None, candidates=()):
+        self.capacity = capacity
+        self.table = np.zeros((SKETCH_DEPTH, SKETCH_WIDTH), dtype=np.uint32) if table is None else np.array(table)
+        self.candidates = dict.fromkeys(candidates, 0)
+        self._floor = 0
+
+    def _columns(self, items):
+        h = _hashes(items)
+        h1, h2 = h & np.uint64(0xFFFFFFFF), (h >> np.uint64(32)) | np.uint64(1)
+        rows = np.arange(SKETCH_DEPTH, dtype=np.uint64)[:, None]
+        return ((h1 + rows * h2) % np.uint64(SKETCH_WIDTH)).astype(np.intp)
+
+    def estimate(self, items):
+        items = list(items)
+        if not items:
+            return np.zeros(0, dtype=np.int64)
+        cols = self._columns(items)
+        return self.table[np.arange(SKETCH_DEPTH)[:, None], cols].min(axis=0).astype(np.int64)
+
+    def update(self, counter):
+        if not counter:
+            return
+        items = list(counter)
+        cols = self._columns(items)
+        counts = np.fromiter(counter.values(), dtype=np.uint32, count=len(items))
+        for row in range(SKETCH_DEPTH):
+            np.add.at(self.table[row], cols[row], counts)
+        estimates = self.table[np.arange(SKETCH_DEPTH)[:, None], cols].min(axis=0)
+        for item, est in zip(items, estimates.tolist()):
+            if est > self._floor or item in self.candidates:
+                self.candidates[item] = est
+        if len(self.candidates) > 2 * self.capacity:
+            self._prune()
+
+    def merge(self, other):
+        self.table += other.table
+        self.candidates.update(dict.fromkeys(other.candidates, 0))
+        self._prune()
+
+    def _prune(self):
+        ranked = self.top(self.capacity)
+        self.candidates = dict(ranked)
+        self._floor = ranked[-1][1] if len(ranked) == self.capacity else 0
+
+    def top(self, n):
+        """[(item, estimated count)] of the n best candidates, highest first."""
+        items = list(self.candidates)
+        ranked = sorted(zip(items, self.estimate(items).tolist()), key=lambda kv: (-kv[1], kv[0]))
+        return ranked[:n]
+
+    @property
+    def total(self):
+        return int(self.table[0].sum(dtype=np.int64))
@@ -1,20 +1,25 @@
 import os
-from tg_client import client
-from user_tools import (
-    fetch_user_by_username,
-    fetch_user_by_phone,
-    fetch_user_messages_from_chat,
-    fetch_user_messages_from_multiple_chats
-)
-from analysis.activity import analyze_hourly_activity
-from analysis.days import analyze_weekday_activity
-from analysis.keywords import analyze_keywords
-from analysis.interactions import analyze_mentions, analyze_replies
+import time
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+import metrics
+from storage import user_folders
+from warehouse import import_data, search, SEARCH_PAGE_SIZE
+
+# CLI_METRICS=1 prints where each menu option spent its time (see metrics.py).
+# CLI_PROFILE=<file> also runs it under cProfile and writes the stats to that
+# file, to be read with `python -m pstats <file>`.
+CLI_METRICS = os.getenv("CLI_METRICS", "") not in ("", "0")
+CLI_PROFILE = os.getenv("CLI_PROFILE") or None
+
+# Telethon (options 1-4) and numpy / matplotlib (options 5-9) are imported by
+# the option that needs them, so the menu comes up at once and the offline
+# options work without Telethon or Telegram credentials.
 
 
 def select_user_folder():
     base_path = "data"
-    folders = [f for f in os.listdir(base_path) if os.path.isdir(os.path.join(base_path, f))]
+    folders = user_folders(base_path)
     if not folders:
         print("No saved users found. Use options 1–4 to add a new one.")
         return None
@@ -35,6 +40,62 @@ def select_user_folder():
         return None
 
 
+def ask_incremental():
+    answer = input("Fetch only new messages since the last run? (Y/n): ").strip().lower()
+    return answer not in ("n", "no")
+
+
+def ask_timezone():
+    tz = input("Timezone (e.g. Europe/Kyiv, empty for UTC): ").strip()
+    if not tz:
+        return None
+    try:
+        ZoneInfo(tz)
+    except (ZoneInfoNotFoundError, ValueError):
+        print("Unknown timezone, using UTC.")
+        return None
+    return tz
+
+
+def search_messages():
+    query = input("Search for (a trailing * matches word prefixes): ").strip()
+    if not query:
+        return
+    chat = input("Only in chat (username, empty for all): ").strip().lstrip("@")
+    page = 1
+    while True:
+        total, results = search(query, chats=[chat] if chat else None, page=page)
+        if not results:
+            print("Nothing found." if page == 1 else "No more results.")
+            return
+        for r in results:
+            date = datetime.fromtimestamp(r["date"], timezone.utc).strftime("%Y-%m-%d %H:%M") if r["date"] else "—"
+            print(f"{date}  @{r['chat']} #{r['message_id']}  from {r['sender_id']}: {r['snippet']}")
+        shown = (page - 1) * SEARCH_PAGE_SIZE + len(results)
+        if shown >= total or input(f"Shown {shown} of {total}. More? (y/N): ").strip().lower() not in ("y", "yes"):
+            return
+        page += 1
+
+
+def run_instrumented(fn, *args):
+    if not CLI_METRICS and not CLI_PROFILE:
+        return fn(*args)
+    metrics.reset()
+    profiler = None
+    if CLI_PROFILE:
+        import cProfile
+        profiler = cProfile.Profile()
+    start = time.perf_counter()
+    try:
+        return profiler.runcall(fn, *args) if profiler else fn(*args)
+    finally:
+        print(f"\n[metrics] {time.perf_counter() - start:.2f} sec")
+        print(metrics.summary())
+        if profiler:
+            profiler.dump_stats(CLI_PROFILE)
+            print(f"[metrics] profile written to {CLI_PROFILE}")
+
+
 def cli_menu():
     while True:
         print("\nTelegram OSINT CLI")
@@ -47,56 +108,81 @@ def cli_menu():
         print("7. Keyword frequency analysis (no AI)")
         print("8. Analyze @username mentions")
         print("9. Analyze reply relationships (who replies to whom)")
+        print("10. Import collected messages into the database")
+        print("11. Full-text search in collected messages")
         print("0. Exit")
 
         choice = input("Choose an option: ")
-        if choice == "1":
-            username = input("Enter username (without @): ")
-            fetch_user_by_username(username)
-        elif choice == "2":
-            phone = input("Enter phone number (+123456789 format): ")
-            fetch_user_by_phone(phone)
-        elif choice == "3":
-            user_username = input("Enter the user's username (without @): ")
-            chat_username = input("Enter chat/group username (without @): ")
-            fetch_user_messages_from_chat(user_username, chat_username)
-        elif choice == "4":
-            user_username = input("Enter the user's username (without @): ")
-            raw_chats = input("Enter chat usernames separated by commas (without @): ")
-            chat_usernames = [chat.strip() for chat in raw_chats.split(",") if chat.strip()]
-            fetch_user_messages_from_multiple_chats(user_username, chat_usernames)
-        elif choice == "5":
-            user_folder = select_user_folder()
-            if user_folder:
-                analyze_hourly_activity(user_folder)
-            else:
-                print("OSINT can be run via options 1–4 for a new user.")
-        elif choice == "6":
-            user_folder = select_user_folder()
-            if user_folder:
-                analyze_weekday_activity(user_folder)
-            else:
-                print("OSINT can be run via options 1–4 for a new user.")
-        elif choice == "7":
-            user_folder = select_user_folder()
-            if user_folder:
-                analyze_keywords(user_folder)
-            else:
-                print("OSINT can be run via options 1–4 for a new user.")
-        elif choice == "8":
-            user_folder = select_user_folder()
-            if user_folder:
-                analyze_mentions(user_folder)
-            else:
-                print("OSINT can be run via options 1–4 for a new user.")
-        elif choice == "9":
-            user_folder = select_user_folder()
-            if user_folder:
-                analyze_replies(user_folder)
-            else:
-                print("OSINT can be run via options 1–4 for a new user.")
-        elif choice == "0":
+        if choice == "0":
             print("Exiting program.")
             break
+        run_instrumented(run_option, choice)
+
+
+def run_option(choice):
+    if choice == "1":
+        from user_tools import fetch_user_by_username
+        username = input("Enter username (without @): ")
+        fetch_user_by_username(username)
+    elif choice == "2":
+        from user_tools import fetch_user_by_phone
+        phone = input("Enter phone number (+123456789 format): ")
+        fetch_user_by_phone(phone)
+    elif choice == "3":
+        from user_tools import fetch_user_messages_from_chat
+        user_username = input("Enter the user's username (without @): ")
+        chat_username = input("Enter chat/group username (without @): ")
+        incremental = ask_incremental()
+        fetch_user_messages_from_chat(user_username, chat_username, incremental=incremental)
+    elif choice == "4":
+        from user_tools import fetch_user_messages_from_multiple_chats
+        user_username = input("Enter the user's username (without @): ")
+        raw_chats = input("Enter chat usernames separated by commas (without @): ")
+        chat_usernames = [chat.strip() for chat in raw_chats.split(",") if chat.strip()]
+        incremental = ask_incremental()
+        fetch_user_messages_from_multiple_chats(user_username, chat_usernames, incremental=incremental)
+    elif choice == "5":
+        user_folder = select_user_folder()
+        if user_folder:
+            from analysis.activity import analyze_hourly_activity
+            analyze_hourly_activity(user_folder, save_path="web/static/activity.png", tz=ask_timezone())
+            print("Chart saved to web/static/activity.png")
+        else:
+            print("OSINT can be run via options 1–4 for a new user.")
+    elif choice == "6":
+        user_folder = select_user_folder()
+        if user_folder:
+            from analysis.days import analyze_weekday_activity
+            analyze_weekday_activity(user_folder, tz=ask_timezone())
+        else:
+            print("OSINT can be run via options 1–4 for a new user.")
+    elif choice == "7":
+        user_folder = select_user_folder()
+        if user_folder:
+            from analysis.keywords import analyze_keywords
+            n = input("Count words (1), word pairs (2) or triples (3)? [1]: ").strip()
+            analyze_keywords(user_folder, ngram=int(n) if n in ("2", "3") else 1)
+        else:
+            print("OSINT can be run via options 1–4 for a new user.")
+    elif choice == "8":
+        user_folder = select_user_folder()
+        if user_folder:
+            from analysis.interactions import analyze_mentions
+            analyze_mentions(user_folder)
+        else:
+            print("OSINT can be run via options 1–4 for a new user.")
+    elif choice == "9":
+        user_folder = select_user_folder()
+        if user_folder:
+            from analysis.interactions import analyze_replies
+            analyze_replies(user_folder)
         else:
-            print("Invalid input, try again.")
+            print("OSINT can be run via options 1–4 for a new user.")
+    elif choice == "10":
+        for target, count in import_data().items():
+            print(f"[+] {target}: {count} messages imported")
+    elif choice == "11":
+        import_data()
+        search_messages()
+    else:
+        print("Invalid input, try again.")
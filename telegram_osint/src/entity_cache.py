@@ -0,0 +1,118 @@
+import os
+import time
+import sqlite3
+
+# Usernames of Telegram users, shared by every user folder. Successful
+# lookups are refreshed after ENTITY_TTL; ids that could not be resolved are
+# remembered for NEGATIVE_TTL so they are not asked for again on every run.
+ENTITY_DB = os.path.join("data", "entities.db")
+ENTITY_TTL = 7 * 24 * 3600
+NEGATIVE_TTL = 24 * 3600
+# users.getUsers accepts up to 200 ids per request.
+RESOLVE_BATCH = 200
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entities (
+    user_id INTEGER PRIMARY KEY,
+    username TEXT,
+    found INTEGER NOT NULL,
+    fetched REAL NOT NULL
+)
+"""
+
+
+def _connect(db_path):
+    os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(_SCHEMA)
+    return conn
+
+
+def lookup(ids, db_path=ENTITY_DB, now=None):
+    """
+    Split ids into cached usernames and ids that need a (re)fetch.
+    Returns ({user_id: username or None}, [user_ids to resolve]); ids cached
+    as unresolvable within NEGATIVE_TTL are in neither.
+    """
+    now = now or time.time()
+    ids = {int(i) for i in ids}
+    hits, fresh = {}, set()
+    conn = _connect(db_path)
+    try:
+        rows = []
+        id_list = list(ids)
+        for i in range(0, len(id_list), 500):
+            chunk = id_list[i:i + 500]
+            rows += conn.execute(
+                f"SELECT user_id, username, found, fetched FROM entities "
+                f"WHERE user_id IN ({','.join('?' * len(chunk))})", chunk
+            ).fetchall()
+    finally:
+        conn.close()
+    for user_id, username, found, fetched in rows:
+        if found and now - fetched < ENTITY_TTL:
+            hits[user_id] = username
+            fresh.add(user_id)
+        elif not found and now - fetched < NEGATIVE_TTL:
+            fresh.add(user_id)
+    return hits, sorted(ids - fresh)
+
+
+def store(found, failed=(), db_path=ENTITY_DB, fetched=None):
+    """Save {user_id: username or None} as resolved and `failed` ids as negative entries."""
+    fetched = fetched or time.time()
+    conn = _connect(db_path)
+    try:
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO entities (user_id, username, found, fetched) VALUES (?, ?, 1, ?)",
+                [(int(uid), username, fetched) for uid, username in found.items()]
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO entities (user_id, username, found, fetched) VALUES (?, NULL, 0, ?)",
+                [(int(uid), fetched) for uid in failed]
+            )
+    finally:
+        conn.close()
+
+
+async def fetch_usernames(client, ids):
+    """
+    Resolve user ids with one users.getUsers call per RESOLVE_BATCH ids,
+    using access hashes the session already knows. Returns
+    ({user_id: username or None}, {ids that could not be resolved}).
+    Only ids Telegram rejects as invalid count as unresolvable; flood
+    waits, dropped connections and other errors are raised, and nothing
+    is cached for them.
+    """
+    from telethon.errors import InputUserDeactivatedError, PeerIdInvalidError, UserIdInvalidError, UserInvalidError
+    from telethon.tl.functions.users import GetUsersRequest
+    from telethon.tl.types import InputUser, User
+    from telethon.utils import get_input_user
+
+    def input_user(uid):
+        try:
+            return get_input_user(client.session.get_input_entity(uid))
+        except (ValueError, TypeError):
+            return InputUser(uid, 0)
+
+    async def get_users(chunk):
+        try:
+            return await client(GetUsersRequest([input_user(uid) for uid in chunk]))
+        except (PeerIdInvalidError, UserIdInvalidError, UserInvalidError, InputUserDeactivatedError):
+            # One bad id fails the whole request; bisect to isolate it.
+            if len(chunk) == 1:
+                return []
+            mid = len(chunk) // 2
+            return await get_users(chunk[:mid]) + await get_users(chunk[mid:])
+
+    found, failed = {}, set()
+    ids = [int(i) for i in ids]
+    for i in range(0, len(ids), RESOLVE_BATCH):
+        chunk = ids[i:i + RESOLVE_BATCH]
+        for user in await get_users(chunk):
+            if isinstance(user, User):
+                found[user.id] = user.username
+        failed.update(uid for uid in chunk if uid not in found)
+    return found, failed
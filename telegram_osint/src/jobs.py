@@ -0,0 +1,157 @@
+import os
+import copy
+import json
+import time
+import uuid
+import asyncio
+
+import user_tools
+from tg_client import service
+
+# Telegram work submitted from the web app runs here instead of inside the
+# request. Jobs run on the Telegram service loop, which owns the one Telethon
+# client. All job state lives on that loop too; other threads only talk to it
+# through the loop. Jobs are persisted so queued and interrupted ones resume after a restart.
+JOB_CONCURRENCY = 2
+PROGRESS_SAVE_INTERVAL = 1.0
+
+ACTIVE = ("queued", "running")
+
+
+async def _search_username(job, save, username):
+    return {"folder": await user_tools.search_user_by_username(username)}
+
+
+async def _search_phone(job, save, phone):
+    return {"folder": await user_tools.search_user_by_phone(phone)}
+
+
+async def _collect(job, save, user_username, chat_usernames, incremental=True):
+    chats = {chat: {"messages": 0, "state": "queued"} for chat in chat_usernames}
+    job["progress"] = {"chats_total": len(chat_usernames), "chats_done": 0, "messages": 0, "chats": chats}
+
+    def progress(chat_username, messages, state):
+        chats[chat_username] = {"messages": messages, "state": state}
+        job["progress"]["messages"] = sum(c["messages"] for c in chats.values())
+        job["progress"]["chats_done"] = sum(c["state"] in ("done", "failed") for c in chats.values())
+        save(force=state != "running")
+
+    result = await user_tools.collect_user_messages(
+        user_username, chat_usernames, incremental=incremental, progress=progress
+    )
+    if result is None:
+        raise LookupError(f"User {user_username} not found")
+    folder, counts = result
+    return {"folder": folder, "messages": sum(counts.values())}
+
+
+JOB_KINDS = {
+    "search_username": _search_username,
+    "search_phone": _search_phone,
+    "collect": _collect,
+}
+
+
+class JobManager:
+    def __init__(self, store_path, concurrency=JOB_CONCURRENCY):
+        self.store_path = store_path
+        self.jobs = {}
+        self._tasks = {}
+        self._last_save = 0
+        self._slots = None
+        self._concurrency = concurrency
+        self.loop = service.loop
+        self._call(self._load)
+
+    def _call(self, fn, *args):
+        """Run fn on the service loop thread and return its result."""
+        async def call():
+            return fn(*args)
+        return asyncio.run_coroutine_threadsafe(call(), self.loop).result()
+
+    def _load(self):
+        if not os.path.exists(self.store_path):
+            return
+        with open(self.store_path, encoding="utf-8") as f:
+            self.jobs = {job["id"]: job for job in json.load(f)}
+        for job in sorted(self.jobs.values(), key=lambda j: j["created"]):
+            if job["status"] in ACTIVE:
+                # Collection picks up from the per-chat checkpoints.
+                if job["kind"] == "collect":
+                    job["params"]["incremental"] = True
+                job["status"] = "queued"
+                self._schedule(job)
+        self._save()
+
+    def _save(self, force=True):
+        now = time.monotonic()
+        if not force and now - self._last_save < PROGRESS_SAVE_INTERVAL:
+            return
+        self._last_save = now
+        os.makedirs(os.path.dirname(self.store_path), exist_ok=True)
+        tmp = self.store_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(list(self.jobs.values()), f, indent=4, ensure_ascii=False)
+        os.replace(tmp, self.store_path)
+
+    def _schedule(self, job):
+        self._tasks[job["id"]] = self.loop.create_task(self._run(job))
+
+    async def _run(self, job):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self._concurrency)
+        try:
+            async with self._slots:
+                job["status"] = "running"
+                job["started"] = time.time()
+                self._save()
+                await service.connect()
+                job["result"] = await JOB_KINDS[job["kind"]](job, self._save, **job["params"])
+                job["status"] = "done"
+        except asyncio.CancelledError:
+            job["status"] = "cancelled"
+        except Exception as e:
+            job["status"] = "failed"
+            job["error"] = str(e)
+        finally:
+            job["finished"] = time.time()
+            self._tasks.pop(job["id"], None)
+            self._save()
+
+    def submit(self, kind, **params):
+        if kind not in JOB_KINDS:
+            raise ValueError(f"Unknown job kind: {kind}")
+        job = {
+            "id": uuid.uuid4().hex[:12],
+            "kind": kind,
+            "params": params,
+            "status": "queued",
+            "created": time.time(),
+            "started": None,
+            "finished": None,
+            "progress": {},
+            "result": None,
+            "error": None,
+        }
+
+        def add():
+            self.jobs[job["id"]] = job
+            self._schedule(job)
+            self._save()
+        self._call(add)
+        return job["id"]
+
+    def get(self, job_id):
+        return self._call(lambda: copy.deepcopy(self.jobs.get(job_id)))
+
+    def list(self):
+        jobs = self._call(lambda: copy.deepcopy(list(self.jobs.values())))
+        return sorted(jobs, key=lambda j: j["created"], reverse=True)
+
+    def cancel(self, job_id):
+        def cancel():
+            task = self._tasks.get(job_id)
+            if task:
+                task.cancel()
+            return task is not None
+        return self._call(cancel)
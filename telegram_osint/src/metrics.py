@@ -0,0 +1,157 @@
+import time
+import threading
+from contextlib import contextmanager
+from functools import wraps
+
+# In-process counters and timers for the hot paths: collection, loading,
+# the analyzers and chart rendering. Updates are a dict lookup under a lock,
+# so they are made per batch, file or stage, never per message. The web app
+# exposes them at /metrics in the Prometheus text format; the CLI prints a
+# summary per menu option with CLI_METRICS=1.
+#
+# Counters are named *_total and timers *_seconds; both take labels as
+# keyword arguments. Work done in other processes (renderers, counting
+# workers) is recorded in the parent from what the worker returns.
+PREFIX = "telegram_osint_"
+
+HELP = {
+    "collect_messages_total": "Messages written to chat dumps",
+    "collect_chats_total": "Chats collected, by outcome",
+    "collect_retries_total": "Collection retries, by reason",
+    "collect_flood_wait_seconds_total": "Seconds slept on Telegram flood waits",
+    "collect_chat_seconds": "Time to collect one chat, retries included",
+    "storage_bytes_written_total": "Bytes appended to chat dumps",
+    "storage_flushes_total": "Batches flushed to chat dumps",
+    "telegram_request_seconds": "Telegram API calls, by request type",
+    "load_files_total": "Chat dumps (or chunks of one) counted into the aggregates",
+    "load_bytes_total": "Bytes of chat dumps counted into the aggregates",
+    "load_messages_total": "Messages counted into the aggregates",
+    "load_seconds": "Time to parse and count one dump or chunk",
+    "aggregates_chats_total": "Chats whose aggregates were read, by whether they had to be updated",
+    "analyze_seconds": "Analyzer runs, by stage",
+    "chart_seconds": "Time to draw and save one chart",
+    "render_seconds": "Chart requests served by the renderer pool, queueing included",
+    "chart_cache_total": "Chart requests, by cache result",
+    "http_request_seconds": "Web requests, by endpoint and status",
+}
+
+_lock = threading.Lock()
+_counters = {}
+# (name, labels) -> [count, total seconds, max seconds]
+_timers = {}
+
+
+def _key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def inc(name, value=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, seconds, **labels):
+    key = _key(name, labels)
+    with _lock:
+        timer = _timers.get(key)
+        if timer is None:
+            _timers[key] = [1, seconds, seconds]
+        else:
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+
+
+@contextmanager
+def span(name, **labels):
+    """Time the block into the `name` timer, also when it raises."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def timed(name, **labels):
+    """Decorator form of span()."""
+    def wrap(fn):
+        @wraps(fn)
+        def call(*args, **kwargs):
+            with span(name, **labels):
+                return fn(*args, **kwargs)
+        return call
+    return wrap
+
+
+def snapshot():
+    """Picklable copy of every counter and timer, for merge() in another process."""
+    with _lock:
+        return {"counters": dict(_counters), "timers": {k: list(v) for k, v in _timers.items()}}
+
+
+def merge(snap):
+    with _lock:
+        for key, value in snap["counters"].items():
+            _counters[key] = _counters.get(key, 0) + value
+        for key, (count, total, peak) in snap["timers"].items():
+            timer = _timers.setdefault(key, [0, 0.0, 0.0])
+            timer[0] += count
+            timer[1] += total
+            timer[2] = max(timer[2], peak)
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _timers.clear()
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    escaped = (v.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for _, v in labels)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + "}"
+
+
+def render_prometheus():
+    """Every metric in the Prometheus text exposition format; timers are summaries."""
+    snap = snapshot()
+    by_name = {}
+    for (name, labels), value in snap["counters"].items():
+        by_name.setdefault(name, ("counter", []))[1].append((labels, value))
+    for (name, labels), value in snap["timers"].items():
+        by_name.setdefault(name, ("summary", []))[1].append((labels, value))
+
+    lines = []
+    for name in sorted(by_name):
+        kind, series = by_name[name]
+        full = PREFIX + name
+        if name in HELP:
+            lines.append(f"# HELP {full} {HELP[name]}.")
+        lines.append(f"# TYPE {full} {kind}")
+        for labels, value in sorted(series):
+            if kind == "counter":
+                lines.append(f"{full}{_labels(labels)} {value}")
+            else:
+                lines.append(f"{full}_count{_labels(labels)} {value[0]}")
+                lines.append(f"{full}_sum{_labels(labels)} {value[1]:.6f}")
+    return "\n".join(lines) + "\n"
+
+
+def summary(snap=None):
+    """Printable table of the timers (slowest total first) and counters."""
+    snap = snap or snapshot()
+    lines = []
+    timers = sorted(snap["timers"].items(), key=lambda kv: -kv[1][1])
+    if timers:
+        lines.append(f"{'timer':<56} {'calls':>7} {'total s':>9} {'mean ms':>9} {'max ms':>9}")
+    for (name, labels), (count, total, peak) in timers:
+        label = name + _labels(labels)
+        lines.append(f"{label:<56} {count:>7} {total:>9.3f} {total / count * 1000:>9.1f} {peak * 1000:>9.1f}")
+    counters = sorted(snap["counters"].items())
+    if counters:
+        lines.append(f"{'counter':<56} {'value':>17}")
+    for (name, labels), value in counters:
+        lines.append(f"{name + _labels(labels):<56} {value:>17,}")
+    return "\n".join(lines)
@@ -0,0 +1,91 @@
+import os
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import metrics
+
+# Charts for the web app are drawn in a small pool of renderer processes.
+# Each process imports matplotlib and the analyzers once and draws a
+# throwaway figure at startup, so a chart request only pays for the
+# drawing itself. Processes are spawned rather than forked from the
+# threaded web server, and each request's figure lives in its own process
+# call, so concurrent charts never share matplotlib state.
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", 2))
+RENDER_TIMEOUT = 300
+CHART_KINDS = ("activity", "days", "keywords", "mentions", "replies")
+
+_pool = None
+_lock = threading.Lock()
+
+
+def _warm_up():
+    import io
+    import importlib
+    import matplotlib
+    matplotlib.use("Agg")
+    from matplotlib.figure import Figure
+    for module in ("activity", "days", "keywords", "interactions"):
+        importlib.import_module(f"analysis.{module}")
+
+    fig = Figure()
+    fig.add_subplot().bar([0], [0])
+    fig.savefig(io.BytesIO(), format="png")
+
+
+def _ready():
+    return os.getpid()
+
+
+def _draw(kind, folder, save_path, args):
+    """Runs in a renderer process; returns the metrics of this chart for the parent."""
+    from analysis.activity import analyze_hourly_activity
+    from analysis.days import analyze_weekday_activity
+    from analysis.keywords import analyze_keywords
+    from analysis.interactions import analyze_mentions, analyze_replies
+
+    metrics.reset()
+    if kind == "activity":
+        analyze_hourly_activity(folder, save_path=save_path, tz=args.get("tz"))
+    elif kind == "days":
+        analyze_weekday_activity(folder, save_path=save_path, tz=args.get("tz"))
+    elif kind == "keywords":
+        analyze_keywords(folder, save_path=save_path, ngram=args.get("n") or 1)
+    elif kind == "mentions":
+        analyze_mentions(folder, top_n=20, save_path=save_path)
+    elif kind == "replies":
+        analyze_replies(folder, top_n=15, save_path=save_path)
+    else:
+        raise ValueError(f"Unknown chart: {kind}")
+    return metrics.snapshot()
+
+
+def pool():
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                RENDER_WORKERS, mp_context=multiprocessing.get_context("spawn"), initializer=_warm_up
+            )
+        return _pool
+
+
+def start():
+    """Start and warm up every renderer process without waiting for them."""
+    executor = pool()
+    for _ in range(RENDER_WORKERS):
+        executor.submit(_ready)
+
+
+def render(kind, folder, save_path, args=None):
+    """Draw one chart in the pool and wait for it; errors are raised here."""
+    with metrics.span("render_seconds", kind=kind):
+        metrics.merge(pool().submit(_draw, kind, folder, save_path, dict(args or {})).result(RENDER_TIMEOUT))
+
+
+def shutdown():
+    global _pool
+    with _lock:
+        if _pool is not None:
+            _pool.shutdown(cancel_futures=True)
+            _pool = None
@@ -0,0 +1,245 @@
+import os
+import json
+import asyncio
+import logging
+import itertools
+from types import SimpleNamespace
+from datetime import datetime, timedelta, timezone
+
+from telethon import types
+from telethon.errors import FloodWaitError
+from telethon.tl.custom.message import Message
+
+import metrics
+from storage import ENTITY_KINDS, chat_name, message_entities, message_files, message_sender, read_messages
+
+# Offline stand-in for TelegramClient, for load-testing collection without
+# network. It covers what user_tools and entity_cache use: connect/start,
+# get_entity, iter_messages, download_profile_photo, and GetFullUserRequest,
+# ImportContactsRequest, DeleteContactsRequest and GetUsersRequest calls.
+# Messages are replayed from serialized records (either dump schema) and
+# handed out as Telethon Message objects, one "request" per REPLAY_BATCH
+# messages, like messages.getHistory. TG_REPLAY=<folder> makes tg_client use
+# it with the dumps of that folder; point it at a copy, not at a folder
+# under data/ that collection writes to. Anything else raises
+# ReplayMissError.
+REPLAY_BATCH = 100
+REPLAYED_METHODS = ("connect", "disconnect", "is_connected", "is_user_authorized", "start", "get_entity",
+                    "iter_messages", "download_profile_photo")
+REPLAYED_REQUESTS = ("GetFullUserRequest", "ImportContactsRequest", "DeleteContactsRequest", "GetUsersRequest")
+
+_ENTITY_CLASSES = {}
+for _name, _kind in ENTITY_KINDS.items():
+    _ENTITY_CLASSES.setdefault(_kind, _name)
+
+# Telethon logs the flood waits it sleeps out itself with this message.
+_log = logging.getLogger("telethon.client.users")
+
+
+def _datetime(value):
+    if isinstance(value, int):
+        return datetime.fromtimestamp(value, timezone.utc)
+    try:
+        return datetime.fromisoformat(value) if value else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _entity(row):
+    kind, offset, length, *extra = row
+    cls = getattr(types, _ENTITY_CLASSES.get(kind, kind), None)
+    try:
+        return cls(offset, length, *extra) if cls else None
+    except TypeError:
+        return None
+
+
+def _media(name):
+    cls = getattr(types, name, None) if name else None
+    try:
+        return cls() if cls else None
+    except TypeError:
+        return None
+
+
+def to_message(record, chat_id=0):
+    """A Telethon Message carrying what user_tools._serialize_message reads."""
+    sender = message_sender(record)
+    reply_to = record.get("reply_to_message_id")
+    entities = [e for e in map(_entity, message_entities(record)) if e is not None]
+    return Message(
+        id=record["id"], peer_id=types.PeerChannel(chat_id), date=_datetime(record.get("date")),
+        message=record.get("text"), from_id=types.PeerUser(sender) if sender else None,
+        reply_to=types.MessageReplyHeader(reply_to_msg_id=reply_to) if reply_to else None,
+        edit_date=_datetime(record.get("edit_date")), media=_media(record.get("media_type")),
+        entities=entities or None,
+    )
+
+
+def _user(info):
+    return types.User(
+        id=info["id"], access_hash=0, first_name=info.get("first_name"), last_name=info.get("last_name"),
+        username=info.get("username"), phone=info.get("phone"),
+        photo=types.UserProfilePhoto(photo_id=info["id"], dc_id=1) if info.get("photo") else None,
+    )
+
+
+class ReplayMissError(AttributeError):
+    """A client method or request that ReplayClient has nothing recorded for."""
+
+
+class _Session:
+    def get_input_entity(self, peer):
+        raise ValueError(f"Could not find the input entity for {peer!r}")
+
+
+class ReplayClient:
+    """
+    `chats` maps chat usernames to callables returning that chat's
+    records in ascending id order; they are called again for every
+    iter_messages, so a chat can grow between runs. `users` are the
+    profiles get_entity and the user requests know, as dicts with id,
+    username, first_name, last_name, phone, about and photo (avatar
+    bytes).
+
+    Faults are injected into history requests, counted over the whole
+    client so that a resumed chat does not fail at the same spot again:
+    every request waits `latency` seconds, every `flood_every`-th one gets
+    a flood wait of `flood_seconds` (slept out here when it is within
+    `flood_sleep_threshold`, as Telethon does, raised otherwise) and every
+    `disconnect_every`-th one drops the connection.
+
+    Only REPLAYED_METHODS and, through the client call, REPLAYED_REQUESTS
+    are answered; any other method or request raises ReplayMissError.
+    """
+
+    def __init__(self, chats, users=(), latency=0.0, connect_latency=0.0, flood_every=0, flood_seconds=1,
+                 flood_sleep_threshold=0, disconnect_every=0, batch_size=REPLAY_BATCH):
+        self.chats = dict(chats)
+        self.users = {info["id"]: info for info in users}
+        self.latency = latency
+        self.connect_latency = connect_latency
+        self.flood_every = flood_every
+        self.flood_seconds = flood_seconds
+        self.flood_sleep_threshold = flood_sleep_threshold
+        self.disconnect_every = disconnect_every
+        self.batch_size = batch_size
+        self.session = _Session()
+        self.requests = 0
+        self.floods = 0
+        self.disconnects = 0
+        self.connects = 0
+        self._connected = False
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        raise ReplayMissError(f"ReplayClient has no recorded {name}(); it replays {', '.join(REPLAYED_METHODS)}")
+
+    @classmethod
+    def from_folder(cls, folder, **kwargs):
+        """Replay the chat dumps of a user folder, with its profile.json as the only known user."""
+        chats = {chat_name(path): (lambda path=path: read_messages(path)) for path in message_files(folder)}
+        users = []
+        profile_path = os.path.join(folder, "profile.json")
+        if os.path.exists(profile_path):
+            with open(profile_path, encoding="utf-8") as f:
+                profile = json.load(f)
+            if profile.get("user_id"):
+                users.append({**profile, "id": profile["user_id"]})
+        return cls(chats, users, **kwargs)
+
+    def is_connected(self):
+        return self._connected
+
+    async def connect(self):
+        if self.connect_latency:
+            await asyncio.sleep(self.connect_latency)
+        self.connects += 1
+        self._connected = True
+
+    async def disconnect(self):
+        self._connected = False
+
+    async def is_user_authorized(self):
+        return True
+
+    async def start(self):
+        if not self._connected:
+            await self.connect()
+        return self
+
+    async def _request(self, name, faults=False):
+        if not self._connected:
+            raise ConnectionError("Not connected")
+        with metrics.span("telegram_request_seconds", request=name):
+            if self.latency:
+                await asyncio.sleep(self.latency)
+        if not faults:
+            return
+        self.requests += 1
+        if self.disconnect_every and self.requests % self.disconnect_every == 0:
+            self.disconnects += 1
+            self._connected = False
+            raise ConnectionError("Connection to Telegram lost (replayed)")
+        if self.flood_every and self.requests % self.flood_every == 0:
+            self.floods += 1
+            if self.flood_seconds > self.flood_sleep_threshold:
+                raise FloodWaitError(request=None, capture=self.flood_seconds)
+            _log.info("Sleeping%s for %ds (%s) on %s flood wait",
+                      "", self.flood_seconds, timedelta(seconds=self.flood_seconds), name)
+            await asyncio.sleep(self.flood_seconds)
+
+    def _find_user(self, key):
+        if isinstance(key, int):
+            return self.users.get(key)
+        key = key.lstrip("@").lower()
+        return next((u for u in self.users.values() if (u.get("username") or "").lower() == key), None)
+
+    async def get_entity(self, entity):
+        await self._request("ResolveUsernameRequest")
+        info = self._find_user(entity)
+        if info is None:
+            raise ValueError(f'No user has "{entity}" as username')
+        return _user(info)
+
+    async def iter_messages(self, entity, limit=None, reverse=False, min_id=0, **kwargs):
+        if entity not in self.chats:
+            raise ValueError(f'Cannot find any entity corresponding to "{entity}"')
+        records = (r for r in self.chats[entity]() if (r.get("id") or 0) > (min_id or 0))
+        if not reverse:
+            records = reversed(list(records))
+        records = itertools.islice(records, limit)
+        while True:
+            batch = list(itertools.islice(records, self.batch_size))
+            if not batch:
+                return
+            await self._request("GetHistoryRequest", faults=True)
+            for record in batch:
+                yield to_message(record)
+
+    async def download_profile_photo(self, entity, file=None, **kwargs):
+        await self._request("GetFileRequest")
+        if not getattr(entity, "photo", None):
+            return None
+        with open(file, "wb") as f:
+            f.write(self._find_user(entity.id).get("photo") or b"")
+        return file
+
+    async def __call__(self, request, ordered=False, flood_sleep_threshold=None):
+        name = type(request).__name__
+        await self._request(name)
+        if name == "GetFullUserRequest":
+            uid = request.id if isinstance(request.id, int) else getattr(request.id, "user_id", None)
+            info = self.users.get(uid) or {"id": uid}
+            return SimpleNamespace(full_user=SimpleNamespace(id=uid, about=info.get("about")), users=[_user(info)])
+        if name == "ImportContactsRequest":
+            phones = {c.phone.lstrip("+") for c in request.contacts}
+            return SimpleNamespace(users=[_user(u) for u in self.users.values()
+                                          if (u.get("phone") or "").lstrip("+") in phones])
+        if name == "DeleteContactsRequest":
+            return None
+        if name == "GetUsersRequest":
+            ids = [getattr(u, "user_id", None) for u in request.id]
+            return [_user(self.users[uid]) for uid in ids if uid in self.users]
+        raise ReplayMissError(f"ReplayClient has no recorded {name}; it answers {', '.join(REPLAYED_REQUESTS)}")
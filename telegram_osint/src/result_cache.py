@@ -0,0 +1,104 @@
+import os
+import hashlib
+import threading
+
+import metrics
+import entity_cache
+from storage import message_files
+
+# Rendered charts are stored on disk keyed by what produced them: the chart
+# kind, the user folder, the request parameters and a fingerprint of the
+# input files. The total size is capped; least recently used entries go first.
+CACHE_DIR = os.path.join("instance", "cache")
+CACHE_MAX_BYTES = 200 * 1024 * 1024
+# Charts labelled with usernames from the entity cache, which is then an input too.
+USERNAME_KINDS = ("mentions", "replies")
+
+_lock = threading.Lock()
+
+
+def input_files(folder, kind=None):
+    files = message_files(folder) if os.path.isdir(folder) else []
+    extra = [os.path.join(folder, "profile.json")]
+    if kind in USERNAME_KINDS:
+        # Recent writes may still sit in the WAL rather than the database file.
+        extra += [entity_cache.ENTITY_DB, entity_cache.ENTITY_DB + "-wal"]
+    return files + [path for path in extra if os.path.exists(path)]
+
+
+def fingerprint(folder, kind=None):
+    """
+    Return (fingerprint, last_modified) for the inputs of a chart kind over
+    a user folder. The fingerprint changes whenever a chat dump or
+    profile.json (and, for the username-labelled kinds, the entity cache) is
+    added, removed or modified (mtime or size); last_modified is the newest
+    mtime.
+    """
+    h = hashlib.sha1()
+    last_modified = 0
+    for path in input_files(folder, kind):
+        st = os.stat(path)
+        h.update(f"{os.path.basename(path)}:{st.st_mtime_ns}:{st.st_size};".encode())
+        last_modified = max(last_modified, st.st_mtime)
+    return h.hexdigest(), last_modified
+
+
+def _key(kind, folder, params):
+    parts = [kind, os.path.basename(os.path.normpath(folder))]
+    parts += [f"{k}={v}" for k, v in sorted(params.items()) if v is not None]
+    return hashlib.sha1("\0".join(parts).encode()).hexdigest()[:16]
+
+
+def cached_artifact(kind, folder, params, render, ext=".png", cache_dir=CACHE_DIR):
+    """
+    Return (path, etag, last_modified) of a cached artifact, calling
+    render(path) only when no artifact exists for the current inputs.
+    Artifacts of the same key built from older inputs are dropped.
+    """
+    fp, last_modified = fingerprint(folder, kind)
+    key = _key(kind, folder, params)
+    etag = f"{key}-{fp[:16]}"
+    path = os.path.join(cache_dir, etag + ext)
+
+    if os.path.exists(path):
+        os.utime(path)
+        metrics.inc("chart_cache_total", result="hit")
+        return path, etag, last_modified
+
+    metrics.inc("chart_cache_total", result="miss")
+    os.makedirs(cache_dir, exist_ok=True)
+    # Keep the extension last: matplotlib picks the format from it.
+    tmp = os.path.join(cache_dir, f"{etag}.{os.getpid()}.{threading.get_ident()}.tmp{ext}")
+    render(tmp)
+    if not os.path.exists(tmp):
+        return None, etag, last_modified
+    os.replace(tmp, path)
+
+    with _lock:
+        for name in os.listdir(cache_dir):
+            if name.startswith(key + "-") and name != etag + ext and ".tmp" not in name:
+                _remove(os.path.join(cache_dir, name))
+        evict(cache_dir)
+    return path, etag, last_modified
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def evict(cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+    entries = []
+    for name in os.listdir(cache_dir):
+        if ".tmp" in name:
+            continue
+        st = os.stat(os.path.join(cache_dir, name))
+        entries.append((st.st_mtime, st.st_size, name))
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total <= max_bytes:
+            break
+        _remove(os.path.join(cache_dir, name))
+        total -= size
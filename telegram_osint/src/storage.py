@@ -0,0 +1,652 @@
+import os
+import json
+import zlib
+import time
+import struct
+import threading
+from array import array
+from datetime import datetime
+
+import metrics
+
+# Line-delimited chat dumps: one serialized message per line, appended as
+# messages arrive. Legacy dumps are a single indented JSON array.
+NDJSON_EXT = ".jsonl"
+LEGACY_EXT = ".json"
+MESSAGE_PREFIX = "messages_"
+# Compressed dumps are the same lines cut into gzip members, one per flushed
+# batch, so `zcat` reads them as plain NDJSON. Each member records its own
+# compressed size in a gzip extra field: readers resume at a member boundary
+# and can walk the members without inflating them. Every byte offset kept
+# about a compressed dump (checkpoints, aggregates, warehouse) is a member
+# boundary. STORAGE_COMPRESSION=none writes plain .jsonl dumps instead.
+GZIP_EXT = ".jsonl.gz"
+STORAGE_COMPRESSION = os.getenv("STORAGE_COMPRESSION", "gzip")
+COMPRESS_LEVEL = 6
+FRAME_HEADER = struct.Struct("<4BI2BH2sHI")
+FRAME_EXTRA_ID = b"TO"
+# Per-chat companion files (checkpoints, indexes, ...) live in this subfolder
+# of the user folder so they never look like chat dumps.
+STATE_DIR = "state"
+CHECKPOINT_SUFFIX = ".checkpoint.json"
+# Held (flock) by whoever is collecting the chat, in any process.
+LOCK_SUFFIX = ".lock"
+
+# A chat is collected once into the shared chat store, a folder laid out like
+# a user folder (dumps plus state/) next to the user folders, however many
+# targets it was collected for. A user folder lists the chats it covers in
+# its manifest; their dumps are read from the store. Dumps kept in the user
+# folder itself (collected before the store existed) are still read until
+# the chat is collected again, which moves them into the store.
+SHARED_DIR = ".chats"
+MANIFEST = "chats.json"
+
+# Companion index: one fixed-size row of native int64 values per stored
+# message, in dump order. Missing values are stored as 0.
+INDEX_SUFFIX = ".idx"
+INDEX_FIELDS = ("date", "sender", "id", "reply_to")
+INDEX_ROW_BYTES = 8 * len(INDEX_FIELDS)
+
+# Persisted per-chat counters maintained by analysis.aggregates.
+AGGREGATE_SUFFIX = ".agg.json"
+KEYWORDS_SUFFIX = ".keywords.json"
+SKETCH_SUFFIX = ".sketch.npy"
+
+# Short kinds of the entities stored in the dumps, by Telethon class name;
+# verbose dumps also keep the others under their class name.
+ENTITY_KINDS = {
+    "MessageEntityMention": "mention",
+    "MessageEntityMentionName": "mention_name",
+    "InputMessageEntityMentionName": "mention_name",
+    "MessageEntityHashtag": "hashtag",
+    "MessageEntityCashtag": "cashtag",
+    "MessageEntityBotCommand": "bot_command",
+    "MessageEntityUrl": "url",
+    "MessageEntityTextUrl": "text_url",
+    "MessageEntityEmail": "email",
+    "MessageEntityPhone": "phone",
+}
+
+BATCH_SIZE = 1000
+READ_CHUNK = 1 << 20
+
+
+def chat_file(folder, chat_username, compression=None):
+    """Path of the dump new messages are written to, in STORAGE_COMPRESSION format by default."""
+    ext = GZIP_EXT if (compression or STORAGE_COMPRESSION) == "gzip" else NDJSON_EXT
+    return os.path.join(folder, f"{MESSAGE_PREFIX}{chat_username}{ext}")
+
+
+def chat_files(folder, chat_username):
+    """Every path a dump of the chat may have, in order of preference."""
+    return [os.path.join(folder, f"{MESSAGE_PREFIX}{chat_username}{ext}") for ext in (GZIP_EXT, NDJSON_EXT, LEGACY_EXT)]
+
+
+def legacy_chat_file(folder, chat_username):
+    return os.path.join(folder, f"{MESSAGE_PREFIX}{chat_username}{LEGACY_EXT}")
+
+
+def state_file(folder, chat_username, suffix):
+    return os.path.join(folder, STATE_DIR, f"{chat_username}{suffix}")
+
+
+def state_files(folder, chat_username):
+    return [state_file(folder, chat_username, suffix)
+            for suffix in (CHECKPOINT_SUFFIX, INDEX_SUFFIX, AGGREGATE_SUFFIX, KEYWORDS_SUFFIX, SKETCH_SUFFIX)]
+
+
+def shared_folder(user_folder):
+    """The shared chat store of the data folder user_folder lives in."""
+    return os.path.join(os.path.dirname(os.path.normpath(user_folder)), SHARED_DIR)
+
+
+def user_folders(data_dir):
+    """Names of the user folders in data_dir; the shared chat store is not one."""
+    return [f for f in sorted(os.listdir(data_dir))
+            if not f.startswith(".") and os.path.isdir(os.path.join(data_dir, f))]
+
+
+def load_manifest(user_folder):
+    """{chat_username: {"added": epoch seconds}} of the shared chats the user folder covers."""
+    path = os.path.join(user_folder, MANIFEST)
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f).get("chats", {})
+
+
+def lock_file(f, blocking=True):
+    """
+    Take an exclusive lock on the open file f, released by unlock_file or
+    closing it. Returns False if it is held elsewhere and blocking is off.
+    flock on POSIX, the first byte through msvcrt on Windows.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        import msvcrt
+        f.seek(0)
+        while True:
+            try:
+                msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+                return True
+            except OSError:
+                if not blocking:
+                    return False
+                time.sleep(0.1)
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+    except BlockingIOError:
+        return False
+    return True
+
+
+def unlock_file(f):
+    try:
+        import fcntl
+    except ImportError:
+        import msvcrt
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        return
+    fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def add_to_manifest(user_folder, chat_username):
+    # Locked, so that collections of other chats in other processes do not drop the entry.
+    with open(os.path.join(user_folder, MANIFEST + LOCK_SUFFIX), "a") as lock:
+        lock_file(lock)
+        chats = load_manifest(user_folder)
+        if chat_username not in chats:
+            chats[chat_username] = {"added": int(time.time())}
+            write_json_atomic(os.path.join(user_folder, MANIFEST), {"chats": chats})
+
+
+def adopt_chat(user_folder, chat_username):
+    """
+    Make the shared store the only copy of a chat the user folder has a dump
+    of: the dump and its state files are moved there, or dropped if the
+    store has the chat already. Returns the shared folder.
+    """
+    shared = shared_folder(user_folder)
+    os.makedirs(os.path.join(shared, STATE_DIR), exist_ok=True)
+    local = [p for p in chat_files(user_folder, chat_username) if os.path.exists(p)]
+    if local:
+        move = not any(os.path.exists(p) for p in chat_files(shared, chat_username))
+        for path in local + state_files(user_folder, chat_username):
+            if not os.path.exists(path):
+                continue
+            if move:
+                os.replace(path, os.path.join(shared, os.path.relpath(path, user_folder)))
+            else:
+                os.remove(path)
+    return shared
+
+
+def index_file(path):
+    return state_file(os.path.dirname(path), chat_name(path), INDEX_SUFFIX)
+
+
+def chat_name(path):
+    name = os.path.basename(path)[len(MESSAGE_PREFIX):]
+    for ext in (GZIP_EXT, NDJSON_EXT, LEGACY_EXT):
+        if name.endswith(ext):
+            return name[:-len(ext)]
+    return name
+
+
+def message_date(msg):
+    """Epoch seconds of a serialized message, or 0. Older dumps store ISO dates."""
+    date = msg.get("date")
+    if isinstance(date, int):
+        return date
+    try:
+        return int(datetime.fromisoformat(date).timestamp()) if date else 0
+    except (TypeError, ValueError):
+        return 0
+
+
+def message_sender(msg):
+    """Sender user id of a serialized message, or 0. Older dumps store a PeerUser dict."""
+    from_id = msg.get("from_id")
+    if isinstance(from_id, dict):
+        from_id = from_id.get("user_id")
+    return from_id if isinstance(from_id, int) else 0
+
+
+def message_entities(msg):
+    """
+    Entities of a serialized message as [kind, offset, length(, user id or
+    url)] rows. Older dumps store Telethon dicts, which are converted; their
+    offsets are UTF-16 code units of the text too.
+    """
+    rows = []
+    for e in msg.get("entities") or ():
+        if isinstance(e, dict):
+            row = [ENTITY_KINDS.get(e.get("_"), e.get("_")), e.get("offset", 0), e.get("length", 0)]
+            extra = e.get("user_id", e.get("url"))
+            if isinstance(extra, dict):
+                # InputMessageEntityMentionName holds an InputUser.
+                extra = extra.get("user_id")
+            if extra is not None:
+                row.append(extra)
+            e = row
+        rows.append(e)
+    return rows
+
+
+def index_record(msg):
+    """Return the (date, sender, id, reply_to) index row of a serialized message."""
+    return message_date(msg), message_sender(msg), msg.get("id") or 0, msg.get("reply_to_message_id") or 0
+
+
+def is_compressed(path):
+    return path.endswith(GZIP_EXT)
+
+
+def is_line_delimited(path):
+    """True for dumps that are appended to and read from byte offsets (.jsonl and .jsonl.gz)."""
+    return path.endswith((NDJSON_EXT, GZIP_EXT))
+
+
+def _dumps(folder, chats=None):
+    # {chat: path} of the dumps in folder, optionally only of the given chats.
+    rank = {GZIP_EXT: 0, NDJSON_EXT: 1, LEGACY_EXT: 2}
+    by_chat = {}
+    if not os.path.isdir(folder):
+        return {}
+    for f in os.listdir(folder):
+        if not f.startswith(MESSAGE_PREFIX):
+            continue
+        ext = next((ext for ext in rank if f.endswith(ext)), None)
+        if ext is None:
+            continue
+        chat = chat_name(f)
+        if chats is not None and chat not in chats:
+            continue
+        if chat not in by_chat or rank[ext] < by_chat[chat][0]:
+            by_chat[chat] = (rank[ext], os.path.join(folder, f))
+    return {chat: path for chat, (_, path) in by_chat.items()}
+
+
+def message_files(folder):
+    """
+    List the chat dumps of a user folder, one path per chat: those of its
+    manifest in the shared store, and the ones kept in the folder itself.
+    When a chat exists in several formats the compressed dump wins, then
+    the plain line-delimited one; the shared dump wins over a local one.
+    """
+    by_chat = _dumps(folder)
+    manifest = load_manifest(folder)
+    if manifest:
+        by_chat.update(_dumps(shared_folder(folder), manifest))
+    return [by_chat[chat] for chat in sorted(by_chat)]
+
+
+def gzip_frame(data, level=COMPRESS_LEVEL):
+    """Compress data into one gzip member whose extra field holds the member's total size."""
+    c = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    body = c.compress(data) + c.flush()
+    size = FRAME_HEADER.size + len(body) + 8
+    # magic, CM=deflate, FLG=FEXTRA, MTIME=0, XFL=0, OS=unknown, XLEN, subfield id, subfield length, size
+    header = FRAME_HEADER.pack(0x1f, 0x8b, 8, 4, 0, 0, 255, 8, FRAME_EXTRA_ID, 4, size)
+    return header + body + struct.pack("<II", zlib.crc32(data), len(data) & 0xffffffff)
+
+
+def frame_offsets(path, start, size):
+    """
+    Start offsets of the gzip members of a compressed dump in [start, size),
+    read from the member headers alone. None if a member was not written
+    by gzip_frame (e.g. the file was recompressed by another tool).
+    """
+    offsets = []
+    with open(path, "rb") as f:
+        pos = start
+        while pos < size:
+            f.seek(pos)
+            header = f.read(FRAME_HEADER.size)
+            if len(header) < FRAME_HEADER.size:
+                break
+            m1, m2, _, flags, _, _, _, _, extra_id, _, frame_size = FRAME_HEADER.unpack(header)
+            if (m1, m2) != (0x1f, 0x8b) or not flags & 4 or extra_id != FRAME_EXTRA_ID:
+                return None
+            offsets.append(pos)
+            pos += frame_size
+    return offsets
+
+
+class MessageWriter:
+    """
+    Append-only writer for line-delimited chat dumps, compressed when the
+    path ends in .jsonl.gz. Records are buffered and flushed to disk (as
+    one gzip member when compressed) every `batch_size` messages, so an
+    interrupted collection keeps everything up to the last batch.
+    With `index_path` the companion index rows are written alongside.
+    """
+
+    def __init__(self, path, mode="w", batch_size=BATCH_SIZE, on_flush=None, index_path=None):
+        self.path = path
+        self.batch_size = batch_size
+        self.on_flush = on_flush
+        self.count = 0
+        self.last = None
+        self._buffer = []
+        self._rows = array("q")
+        self.compressed = is_compressed(path)
+        self._file = open(path, mode + "b")
+        self._index = None
+        if index_path:
+            os.makedirs(os.path.dirname(index_path), exist_ok=True)
+            self._index = open(index_path, mode + "b")
+        self.offset = self._file.tell()
+
+    def write(self, record):
+        self._buffer.append(json.dumps(record, ensure_ascii=False))
+        if self._index:
+            self._rows.extend(index_record(record))
+        self.count += 1
+        self.last = record
+        if len(self._buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._buffer:
+            return
+        data = ("\n".join(self._buffer) + "\n").encode("utf-8")
+        self._file.write(gzip_frame(data) if self.compressed else data)
+        self._buffer = []
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        metrics.inc("storage_bytes_written_total", self._file.tell() - self.offset)
+        metrics.inc("storage_flushes_total")
+        self.offset = self._file.tell()
+        if self._index:
+            # Written after the dump, so an index newer than its dump is complete.
+            self._rows.tofile(self._index)
+            self._rows = array("q")
+            self._index.flush()
+        if self.on_flush:
+            self.on_flush(self)
+
+    def close(self):
+        if not self._file.closed:
+            self.flush()
+            self._file.close()
+        if self._index and not self._index.closed:
+            self._index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _iter_ndjson(f):
+    for line in f:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except json.JSONDecodeError:
+            # A torn last line from an interrupted run.
+            continue
+
+
+def _iter_json_array(f, chunk_size=READ_CHUNK):
+    decoder = json.JSONDecoder()
+    buf = ""
+    pos = 0
+    started = False
+    while True:
+        while pos < len(buf) and (buf[pos].isspace() or buf[pos] == ","):
+            pos += 1
+        if pos == len(buf):
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            buf, pos = chunk, 0
+            continue
+        if not started:
+            if buf[pos] != "[":
+                raise ValueError(f"{f.name}: expected a JSON array")
+            started = True
+            pos += 1
+            continue
+        if buf[pos] == "]":
+            return
+        try:
+            obj, pos = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                raise
+            buf, pos = buf[pos:] + chunk, 0
+            continue
+        yield obj
+
+
+def _iter_frames(f, start, end=None):
+    """
+    Inflate the gzip members of f one at a time from offset `start` (a
+    member boundary) and yield (data, end offset of the member). A member
+    torn by an interrupted write ends the stream.
+    """
+    f.seek(start)
+    pending = b""
+    while end is None or start < end:
+        d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        parts = []
+        data = pending
+        while True:
+            if not data:
+                data = f.read(READ_CHUNK)
+                if not data:
+                    return
+            try:
+                parts.append(d.decompress(data))
+            except zlib.error:
+                return
+            if d.eof:
+                start += len(data) - len(d.unused_data)
+                pending = d.unused_data
+                break
+            start += len(data)
+            data = b""
+        yield b"".join(parts), start
+
+
+def iter_raw_lines(path, start=0, end=None):
+    """
+    Yield (line, end offset) for the complete lines of a line-delimited dump
+    from byte offset `start` up to `end`, if given. For a compressed dump
+    every line of a member carries the member's end offset, the first
+    offset a reader can resume from.
+    """
+    with open(path, "rb") as f:
+        if is_compressed(path):
+            for data, offset in _iter_frames(f, start, end):
+                for line in data.splitlines():
+                    yield line, offset
+            return
+        f.seek(start)
+        for line in f:
+            if not line.endswith(b"\n") or (end is not None and start >= end):
+                break
+            start += len(line)
+            yield line, start
+
+
+def iter_new_lines(path, start, end=None):
+    """
+    Yield (message, end offset) for the complete lines of a .jsonl or
+    .jsonl.gz dump from byte offset `start` up to `end`, if given.
+    """
+    for line, offset in iter_raw_lines(path, start, end):
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line), offset
+        except ValueError:
+            continue
+
+
+def read_messages(path):
+    """Stream the messages of one chat dump without loading the whole file."""
+    if is_compressed(path):
+        yield from (msg for msg, _ in iter_new_lines(path, 0))
+        return
+    with open(path, encoding="utf-8") as f:
+        if path.endswith(NDJSON_EXT):
+            yield from _iter_ndjson(f)
+        else:
+            yield from _iter_json_array(f)
+
+
+def write_json_atomic(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Unique per writer: several processes may refresh the same state file.
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=4, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def load_checkpoint(folder, chat_username):
+    path = state_file(folder, chat_username, CHECKPOINT_SUFFIX)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_checkpoint(folder, chat_username, checkpoint):
+    write_json_atomic(state_file(folder, chat_username, CHECKPOINT_SUFFIX), checkpoint)
+
+
+def dump_generation(path):
+    """
+    How many times the dump at `path` has been rewritten from scratch, as
+    kept in its checkpoint (0 without one). Byte offsets remembered about
+    an older generation do not apply to the current dump.
+    """
+    checkpoint = load_checkpoint(os.path.dirname(path), chat_name(path))
+    return checkpoint.get("generation", 0) if checkpoint else 0
+
+
+def rebuild_checkpoint(folder, chat_username):
+    """
+    Derive a checkpoint for a chat that has no (valid) one: convert a dump
+    in another format (legacy .json, or .jsonl <-> .jsonl.gz when
+    STORAGE_COMPRESSION changed) to the current one, or scan the existing
+    dump for its last message. Returns None if the chat has never been
+    collected.
+    """
+    path = chat_file(folder, chat_username)
+    if not os.path.exists(path):
+        old = next((p for p in chat_files(folder, chat_username) if p != path and os.path.exists(p)), None)
+        if old is None:
+            return None
+        with MessageWriter(path, index_path=index_file(path)) as writer:
+            for msg in read_messages(old):
+                writer.write(msg)
+        os.remove(old)
+
+    checkpoint = {"last_id": 0, "last_date": None, "count": 0, "bytes": 0}
+    for line, offset in iter_raw_lines(path):
+        try:
+            msg = json.loads(line)
+        except ValueError:
+            break
+        checkpoint["last_id"] = max(checkpoint["last_id"], msg.get("id") or 0)
+        checkpoint["last_date"] = msg.get("date") or checkpoint["last_date"]
+        checkpoint["count"] += 1
+        checkpoint["bytes"] = offset
+    save_checkpoint(folder, chat_username, checkpoint)
+    return checkpoint
+
+
+def open_chat_writer(folder, chat_username, incremental=True, batch_size=BATCH_SIZE):
+    """
+    Open the writer for collecting a chat together with its checkpoint;
+    checkpoint["last_id"] is the message id to resume after.
+    In incremental mode the dump is truncated back to the last checkpointed
+    batch and new messages are appended after it; otherwise it is rewritten
+    as a new generation. The checkpoint is saved after every flushed batch.
+    """
+    path = chat_file(folder, chat_username)
+    checkpoint = None
+    if incremental:
+        checkpoint = load_checkpoint(folder, chat_username)
+        if checkpoint is None or not os.path.exists(path) or os.path.getsize(path) < checkpoint["bytes"]:
+            checkpoint = rebuild_checkpoint(folder, chat_username)
+
+    index_path = index_file(path)
+    discard_aggregates(folder, chat_username, checkpoint["bytes"] if checkpoint else 0)
+    if checkpoint:
+        with open(path, "r+b") as f:
+            f.truncate(checkpoint["bytes"])
+        # Checkpoints of chats without messages, or older than the index, may have no index file.
+        if not os.path.exists(index_path) or os.path.getsize(index_path) // INDEX_ROW_BYTES < checkpoint["count"]:
+            build_index(path)
+        with open(index_path, "r+b") as f:
+            f.truncate(checkpoint["count"] * INDEX_ROW_BYTES)
+        mode = "a"
+    else:
+        previous = load_checkpoint(folder, chat_username) or {}
+        checkpoint = {"last_id": 0, "last_date": None, "count": 0, "bytes": 0,
+                      "generation": previous.get("generation", 0) + 1}
+        mode = "w"
+    base_count = checkpoint["count"]
+
+    def on_flush(writer):
+        checkpoint["last_id"] = writer.last.get("id") or checkpoint["last_id"]
+        checkpoint["last_date"] = writer.last.get("date")
+        checkpoint["count"] = base_count + writer.count
+        checkpoint["bytes"] = writer.offset
+        save_checkpoint(folder, chat_username, checkpoint)
+
+    writer = MessageWriter(path, mode=mode, batch_size=batch_size, on_flush=on_flush, index_path=index_path)
+    if mode == "w":
+        # Saved once the old dump is truncated, so readers see the new generation from its first byte.
+        save_checkpoint(folder, chat_username, checkpoint)
+    return writer, checkpoint
+
+
+def discard_aggregates(folder, chat_username, keep_bytes=0):
+    """Drop the chat's aggregates if they cover more of the dump than the first keep_bytes."""
+    path = state_file(folder, chat_username, AGGREGATE_SUFFIX)
+    if not os.path.exists(path):
+        return
+    try:
+        with open(path, encoding="utf-8") as f:
+            covered = json.load(f).get("bytes", 0)
+    except ValueError:
+        covered = keep_bytes + 1
+    if covered > keep_bytes:
+        os.remove(path)
+
+
+def build_index(path):
+    """(Re)build the companion index of a chat dump by streaming it once."""
+    index_path = index_file(path)
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    tmp = f"{index_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+        rows = array("q")
+        for msg in read_messages(path):
+            rows.extend(index_record(msg))
+            if len(rows) >= BATCH_SIZE * len(INDEX_FIELDS):
+                rows.tofile(f)
+                rows = array("q")
+        rows.tofile(f)
+    os.replace(tmp, index_path)
+    return index_path
+
+
+def index_is_fresh(path):
+    index_path = index_file(path)
+    if not os.path.exists(index_path):
+        return False
+    return os.stat(index_path).st_mtime_ns >= os.stat(path).st_mtime_ns
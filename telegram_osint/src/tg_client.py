@@ -1,10 +1,162 @@
-from telethon.sync import TelegramClient
-from dotenv import load_dotenv
 import os
+import atexit
+import asyncio
+import logging
+import threading
+
+from dotenv import load_dotenv
+
+import metrics
 
 load_dotenv()
 
-api_id = int(os.getenv("API_ID"))
-api_hash = os.getenv("API_HASH")
+SESSION_NAME = "session"
+# TG_REPLAY=<user folder> replays that folder's dumps through
+# replay_client.ReplayClient instead of connecting to Telegram.
+TG_REPLAY = os.getenv("TG_REPLAY") or None
+
+
+def load_config():
+    """
+    Telegram credentials from the environment (.env is loaded first).
+    TG_API_ID / TG_API_HASH / TG_SESSION are used everywhere; the older
+    API_ID / API_HASH names are still accepted.
+    """
+    api_id = os.getenv("TG_API_ID") or os.getenv("API_ID")
+    api_hash = os.getenv("TG_API_HASH") or os.getenv("API_HASH")
+    if not api_id or not api_hash:
+        raise RuntimeError("Telegram credentials missing: set TG_API_ID and TG_API_HASH")
+    return {"api_id": int(api_id), "api_hash": api_hash, "session": os.getenv("TG_SESSION")}
+
+
+class _FloodWaitLog(logging.Handler):
+    """
+    Telethon sleeps out short flood waits itself and only logs them; the
+    record's arguments are (" early" or "", seconds, timedelta, request).
+    """
+
+    def emit(self, record):
+        if "flood wait" in str(record.msg) and len(record.args or ()) == 4:
+            metrics.inc("collect_flood_wait_seconds_total", record.args[1])
+
+
+def _watch_flood_waits():
+    log = logging.getLogger("telethon.client.users")
+    if not any(isinstance(h, _FloodWaitLog) for h in log.handlers):
+        log.addHandler(_FloodWaitLog(logging.INFO))
+        if log.getEffectiveLevel() > logging.INFO:
+            log.setLevel(logging.INFO)
+
+
+def _client_class():
+    """TelegramClient with every API call timed into metrics, by request type."""
+    from telethon import TelegramClient
+
+    class InstrumentedClient(TelegramClient):
+        async def __call__(self, request, ordered=False, flood_sleep_threshold=None):
+            with metrics.span("telegram_request_seconds", request=type(request).__name__):
+                return await super().__call__(request, ordered, flood_sleep_threshold)
+
+    return InstrumentedClient
+
+
+class TelegramService:
+    """
+    One long-lived Telethon client living on its own event loop thread.
+    It connects on first use and keeps the MTProto connection for every
+    later call. Coroutines that use the client must run on `loop`: from sync
+    code go through run(), from another event loop through call().
+    """
+
+    def __init__(self, client_factory=None):
+        self.loop = asyncio.new_event_loop()
+        self.client = None
+        self.client_factory = client_factory
+        self._authorized = False
+        self._connect_lock = None
+        self._thread = threading.Thread(target=self.loop.run_forever, name="telegram", daemon=True)
+        self._thread.start()
+
+    async def connect(self, interactive=True):
+        """
+        Return the shared client, connected and logged in. Only the first
+        call pays for the handshake. With interactive=False an unauthorized
+        session raises instead of prompting for a login code.
+        """
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+        async with self._connect_lock:
+            if self.client is None:
+                _watch_flood_waits()
+            if self.client is None and self.client_factory is None and TG_REPLAY:
+                from replay_client import ReplayClient
+                self.client_factory = lambda: ReplayClient.from_folder(TG_REPLAY)
+            if self.client is None and self.client_factory is not None:
+                self.client = self.client_factory()
+            if self.client is None:
+                from telethon.sessions import StringSession
+                config = load_config()
+                session = StringSession(config["session"]) if config["session"] else SESSION_NAME
+                self.client = _client_class()(session, config["api_id"], config["api_hash"])
+            if not self.client.is_connected():
+                await self.client.connect()
+            if not self._authorized:
+                if not await self.client.is_user_authorized():
+                    if not interactive:
+                        raise RuntimeError("Telegram session is not authorized")
+                    await self.client.start()
+                self._authorized = True
+        return self.client
+
+    def use_client(self, factory):
+        """Make the next connect() build its client with factory(), e.g. an offline ReplayClient."""
+        async def swap():
+            if self.client is not None and self.client.is_connected():
+                await self.client.disconnect()
+            self.client, self.client_factory, self._authorized = None, factory, False
+        self.run(swap())
+
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro):
+        """Sync facade: run a coroutine on the service loop and wait for its result."""
+        if threading.current_thread() is self._thread:
+            raise RuntimeError("TelegramService.run() called from the service loop; await the coroutine instead")
+        return self.submit(coro).result()
+
+    async def call(self, coro):
+        """Async facade for callers running on a different event loop."""
+        if asyncio.get_running_loop() is self.loop:
+            return await coro
+        return await asyncio.wrap_future(self.submit(coro))
+
+    def close(self):
+        if self.client is not None and self.client.is_connected():
+            try:
+                self.submit(self.client.disconnect()).result(timeout=10)
+            except Exception:
+                pass
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_service():
+    """The process-wide TelegramService, created (and its loop started) on first use."""
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = TelegramService()
+            atexit.register(_service.close)
+        return _service
+
 
-client = TelegramClient("session", api_id, api_hash)
+def __getattr__(name):
+    # `from tg_client import service` keeps working but no longer starts a
+    # loop thread for code paths that never talk to Telegram.
+    if name == "service":
+        return get_service()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -2,19 +2,38 @@ import asyncio
 import json
 import os
 import time
+import sqlite3
+from contextlib import asynccontextmanager, closing
 from datetime import datetime
 
-from tg_client import client
+from tg_client import service
 from telethon.tl.functions.contacts import ImportContactsRequest, DeleteContactsRequest
 from telethon.tl.types import InputPhoneContact
 from telethon.tl.types import UserStatusOnline, UserStatusOffline, UserStatusRecently, UserStatusLastMonth, UserStatusLastWeek
 from telethon.tl.functions.users import GetFullUserRequest
 from telethon.tl.types import PeerUser
-import nest_asyncio
-nest_asyncio.apply()
+from telethon.errors import FloodWaitError
+import entity_cache
+import metrics
+import warehouse
+from storage import (ENTITY_KINDS, LOCK_SUFFIX, add_to_manifest, adopt_chat, chat_files, load_checkpoint,
+                     lock_file, open_chat_writer, save_checkpoint, shared_folder, state_file, unlock_file)
+
+# Chats downloaded at the same time by fetch_user_messages_from_multiple_chats.
+COLLECT_CONCURRENCY = int(os.getenv("COLLECT_CONCURRENCY", "4"))
+COLLECT_MAX_RETRIES = 5
+COLLECT_BACKOFF = 5
+# COLLECT_VERBOSE=1 also stores forward headers and reply markup of every message.
+COLLECT_VERBOSE = os.getenv("COLLECT_VERBOSE", "") not in ("", "0")
+# An incremental collection skips a chat of the shared store that was brought
+# up to date this recently, e.g. for another target of the same batch.
+CHAT_FRESH_SECONDS = int(os.getenv("CHAT_FRESH_SECONDS", "600"))
+# How often a collection waiting for a chat's lock checks it again.
+CHAT_LOCK_POLL = 0.5
 
 
 async def _get_user_by_phone(phone):
+    client = await service.connect()
     contact = InputPhoneContact(client_id=0, phone=phone, first_name="Not Known", last_name="Not Known")
     result = await client(ImportContactsRequest([contact]))
     user = result.users[0] if result.users else None
@@ -23,6 +42,7 @@ async def _get_user_by_phone(phone):
 
 
 async def _get_user_by_username(username):
+    client = await service.connect()
     user = await client.get_entity(username)
     return user
 
@@ -70,124 +90,327 @@ async def download_avatar(user):
         folder_name = username or str(user.id)
         os.makedirs(f"data/{folder_name}/avatars", exist_ok=True)
         path = f"data/{folder_name}/avatars/{user.id}.jpg"
+        client = await service.connect()
         await client.download_profile_photo(user, file=path)
 
 
+def _folder_name(user):
+    username = user.username.lstrip("@") if user.username else None
+    return username or str(user.id)
+
+
+async def _save_user(user):
+    client = await service.connect()
+    full_user = await client(GetFullUserRequest(user.id))
+    await download_avatar(user)
+    save_user_profile(user, full_user)
+    print(f"[+] User profile {user.username or user.id} saved.")
+    return _folder_name(user)
+
+
+async def search_user_by_username(username):
+    """Fetch and save a user's profile and avatar. Returns the data folder name, or None."""
+    user = await _get_user_by_username(username)
+    if not user:
+        print("User not found.")
+        return None
+    return await _save_user(user)
+
+
+async def search_user_by_phone(phone):
+    user = await _get_user_by_phone(phone)
+    if not user:
+        print("User not found.")
+        return None
+    return await _save_user(user)
+
+
+def _run(make_coro):
+    # The shared client stays connected between calls.
+    return service.run(make_coro())
+
+
 def fetch_user_by_username(username):
-    async def run():
-        await client.start()
-        user = await _get_user_by_username(username)
-        if user:
-            full_user = await client(GetFullUserRequest(user.id))
-            await download_avatar(user)
-            save_user_profile(user, full_user)
-            print(f"[+] User profile {user.username or user.id} saved.")
-        else:
-            print("User not found.")
-        await client.disconnect()
-    asyncio.run(run())
+    return _run(lambda: search_user_by_username(username))
 
 
 def fetch_user_by_phone(phone):
-    async def run():
-        await client.start()
-        user = await _get_user_by_phone(phone)
-        if user:
-            full_user = await client(GetFullUserRequest(user.id))
-            await download_avatar(user)
-            save_user_profile(user, full_user)
-            print(f"[+] User profile {user.username or user.id} saved.")
-        else:
-            print("User not found.")
-        await client.disconnect()
-    asyncio.run(run())
+    return _run(lambda: search_user_by_phone(phone))
 
 
-def _serialize_message(message):
-    def safe_to_dict(obj):
-        try:
-            d = obj.to_dict()
-            for k, v in d.items():
-                if isinstance(v, datetime):
-                    d[k] = v.isoformat()
-            return d
-        except:
-            return str(obj)
-
-    return {
-        "id": message.id,
-        "date": message.date.isoformat() if message.date else None,
-        "edit_date": message.edit_date.isoformat() if getattr(message, "edit_date", None) else None,
-        "text": message.text,
-        "from_id": message.from_id.to_dict() if message.from_id else None,
-        "reply_to_message_id": getattr(message, "reply_to_msg_id", None),
-        "media_type": type(message.media).__name__ if message.media else None,
-        "fwd_from": safe_to_dict(message.fwd_from) if message.fwd_from else None,
-        "entities": [e.to_dict() for e in message.entities] if message.entities else None,
-        "reply_markup": safe_to_dict(message.reply_markup) if message.reply_markup else None
-    }
+def _epoch(dt):
+    return int(dt.timestamp()) if dt else None
 
 
-def fetch_user_messages_from_chat(user_username, chat_username, limit=500000):
-    async def run():
-        await client.start()
-        user = await _get_user_by_username(user_username)
-        if not user:
-            print("User not found.")
-            return
+def _payload(obj):
+    # Raw TL objects for verbose dumps; to_dict() keeps nested datetimes.
+    try:
+        return json.loads(json.dumps(obj.to_dict(), default=lambda v: v.isoformat() if isinstance(v, datetime) else str(v)))
+    except Exception:
+        return str(obj)
 
-        messages = []
-        async for message in client.iter_messages(chat_username, limit=limit, reverse=True):
-            if message.from_id and isinstance(message.from_id, PeerUser):
-                messages.append(_serialize_message(message))
 
-        username = user.username.lstrip("@") if user.username else None
-        folder_name = username or str(user.id)
-        os.makedirs("data/" + folder_name, exist_ok=True)
-        with open(f"data/{folder_name}/messages_{chat_username}.json", "w", encoding="utf-8") as f:
-            json.dump(messages, f, indent=4, ensure_ascii=False)
+def _entity(e):
+    kind = type(e).__name__
+    row = [ENTITY_KINDS.get(kind, kind), e.offset, e.length]
+    if hasattr(e, "user_id"):
+        row.append(e.user_id)
+    elif hasattr(e, "url"):
+        row.append(e.url)
+    return row
+
 
-        print(f"[+] Total messages: {len(messages)} in @{chat_username}")
-        await client.disconnect()
-    asyncio.run(run())
+def _serialize_message(message, verbose=False):
+    """
+    One message in the dump schema: ints for ids and dates (epoch seconds),
+    the raw text, and entities as [kind, offset, length] rows (plus the
+    user id of a mention by name or the url of a text link); offsets are
+    in UTF-16 code units of the text. Formatting entities, forward headers
+    and reply markup are only stored with verbose=True.
+    """
+    record = {
+        "id": message.id,
+        "date": _epoch(message.date),
+        "edit_date": _epoch(message.edit_date),
+        "text": message.message,
+        "from_id": message.from_id.user_id,
+        "reply_to_message_id": message.reply_to_msg_id,
+        "media_type": type(message.media).__name__ if message.media else None,
+        "entities": [_entity(e) for e in message.entities or () if verbose or type(e).__name__ in ENTITY_KINDS] or None,
+    }
+    if verbose:
+        record["fwd_from"] = _payload(message.fwd_from) if message.fwd_from else None
+        record["reply_markup"] = _payload(message.reply_markup) if message.reply_markup else None
+    return record
+
+
+async def _collect_chat(folder, chat_username, limit, incremental=True, progress=None):
+    """
+    Stream the chat into messages_<chat>.jsonl.gz of the shared store
+    `folder` as iter_messages yields, flushing in batches. In incremental
+    mode only messages newer than the stored checkpoint are requested and
+    appended; an interrupted run resumes from the last flushed batch.
+    Returns the number of messages written.
+    """
+    client = await service.connect()
+    writer, checkpoint = open_chat_writer(folder, chat_username, incremental)
+    # Only a run that gets to the end marks the chat as up to date.
+    checkpoint.pop("collected", None)
+    if progress:
+        writer.on_flush = _chain(writer.on_flush, lambda w: progress(chat_username, w.count))
+    last_seen = checkpoint["last_id"]
+    try:
+        with writer:
+            async for message in client.iter_messages(chat_username, limit=limit, reverse=True, min_id=last_seen):
+                last_seen = message.id
+                if message.from_id and isinstance(message.from_id, PeerUser):
+                    writer.write(_serialize_message(message, COLLECT_VERBOSE))
+    finally:
+        metrics.inc("collect_messages_total", writer.count)
+
+    checkpoint["last_id"] = max(checkpoint["last_id"], last_seen)
+    checkpoint["collected"] = int(time.time())
+    save_checkpoint(folder, chat_username, checkpoint)
+
+    # A full re-collection leaves dumps in other formats behind.
+    for old in chat_files(folder, chat_username):
+        if old != writer.path and os.path.exists(old):
+            os.remove(old)
+    return writer.count
+
+
+@asynccontextmanager
+async def _chat_lock(folder, chat_username):
+    """
+    Hold the chat's lock file in the shared store `folder`. Collections of
+    the same chat in this or any other process (the CLI, the web app's
+    jobs) wait for it, polling so the event loop keeps running meanwhile.
+    """
+    path = state_file(folder, chat_username, LOCK_SUFFIX)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a") as f:
+        while not lock_file(f, blocking=False):
+            await asyncio.sleep(CHAT_LOCK_POLL)
+        try:
+            yield
+        finally:
+            unlock_file(f)
+
+
+def _chain(*callbacks):
+    def call(*args):
+        for cb in callbacks:
+            cb(*args)
+    return call
+
+
+async def _collect_chat_with_retry(folder, chat_username, limit, incremental=True, progress=None):
+    """
+    Collect one chat for the user folder into the shared store and add it
+    to the folder's manifest. Only messages the store does not have yet are
+    requested, and in incremental mode a chat collected within
+    CHAT_FRESH_SECONDS is not requested at all. FloodWait is slept out and
+    dropped connections are backed off from; only the awaiting worker
+    pauses, and after a retry the chat resumes from its checkpoint instead
+    of starting over. Returns the number of messages added to the store.
+    """
+    store = shared_folder(folder)
+    async with _chat_lock(store, chat_username):
+        adopt_chat(folder, chat_username)
+        add_to_manifest(folder, chat_username)
+        checkpoint = load_checkpoint(store, chat_username) or {}
+        age = time.time() - checkpoint.get("collected", 0)
+        if incremental and age < CHAT_FRESH_SECONDS:
+            print(f"[=] @{chat_username}: already collected {age:.0f} sec ago, skipped.")
+            metrics.inc("collect_chats_total", outcome="fresh")
+            count = 0
+        else:
+            with metrics.span("collect_chat_seconds"):
+                try:
+                    count = await _collect_chat_retrying(store, chat_username, limit, incremental, progress)
+                except BaseException:
+                    metrics.inc("collect_chats_total", outcome="failed")
+                    raise
+            metrics.inc("collect_chats_total", outcome="done")
+
+    # SQLite work; in a thread so the other chats and jobs on the loop keep running.
+    await asyncio.to_thread(_ingest, folder, store, chat_username)
+    return count
+
+
+def _ingest(folder, store, chat_username):
+    try:
+        with closing(warehouse.connect()) as conn:
+            for path in chat_files(store, chat_username):
+                if os.path.exists(path):
+                    warehouse.ingest_file(conn, os.path.basename(os.path.normpath(folder)), path)
+    except sqlite3.Error as e:
+        print(f"[!] @{chat_username}: saved, but not added to the warehouse: {e}")
+
+
+async def _collect_chat_retrying(folder, chat_username, limit, incremental, progress):
+    def stored():
+        checkpoint = load_checkpoint(folder, chat_username)
+        return checkpoint["count"] if checkpoint else 0
+
+    base = stored() if incremental else 0
+    for attempt in range(COLLECT_MAX_RETRIES + 1):
+        done = stored() - base if attempt else 0
+        on_flush = (lambda chat, count: progress(chat, done + count)) if progress else None
+        try:
+            await _collect_chat(folder, chat_username, limit - done, incremental, on_flush)
+            return stored() - base
+        except FloodWaitError as e:
+            if attempt == COLLECT_MAX_RETRIES:
+                raise
+            print(f"[~] @{chat_username}: flood wait, sleeping {e.seconds} sec.")
+            metrics.inc("collect_retries_total", reason="flood_wait")
+            metrics.inc("collect_flood_wait_seconds_total", e.seconds)
+            await asyncio.sleep(e.seconds)
+        except (ConnectionError, OSError) as e:
+            if attempt == COLLECT_MAX_RETRIES:
+                raise
+            delay = COLLECT_BACKOFF * 2 ** attempt
+            print(f"[~] @{chat_username}: {e}, retrying in {delay} sec.")
+            metrics.inc("collect_retries_total", reason="connection")
+            await asyncio.sleep(delay)
+        incremental = True
+
+
+async def collect_user_messages(user_username, chat_usernames: list, limit=500000, incremental=True,
+                                concurrency=COLLECT_CONCURRENCY, progress=None):
+    """
+    Collect the given chats into the user's data folder, up to `concurrency`
+    chats at a time. progress(chat_username, messages, state) is called as
+    batches are flushed ("running") and when a chat ends ("done"/"failed").
+    Returns (data folder name, {chat_username: new messages}), or None if
+    the user is not found.
+    """
+    user = await _get_user_by_username(user_username)
+    if not user:
+        print("User not found.")
+        return None
+
+    folder_name = _folder_name(user)
+    os.makedirs("data/" + folder_name, exist_ok=True)
+    total_chats = len(chat_usernames)
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    def on_flush(chat_username, count):
+        if count % 10000 == 0:
+            print(f"[.] @{chat_username}: {count} messages so far...")
+        if progress:
+            progress(chat_username, count, "running")
+
+    async def worker(i, chat_username):
+        async with semaphore:
+            print(f"\n[{i}/{total_chats}] [{datetime.now().strftime('%H:%M:%S')}] Processing @{chat_username}...")
+            start = time.perf_counter()
+            try:
+                count = await _collect_chat_with_retry(
+                    f"data/{folder_name}", chat_username, limit, incremental, on_flush
+                )
+            except Exception as e:
+                print(f"[!] Error processing @{chat_username}: {e}")
+                if progress:
+                    progress(chat_username, 0, "failed")
+                return 0
+            duration = time.perf_counter() - start
+            print(f"[+] @{chat_username}: {count} messages saved in {duration:.2f} sec.")
+            if progress:
+                progress(chat_username, count, "done")
+            return count
+
+    counts = await asyncio.gather(*(worker(i, chat) for i, chat in enumerate(chat_usernames, 1)))
+    await resolve_referenced_users(f"data/{folder_name}")
+    return folder_name, dict(zip(chat_usernames, counts))
+
+
+async def resolve_referenced_users(folder):
+    """
+    Resolve the usernames of the users the folder's messages mention or
+    reply to into the entity cache, so the mention and reply charts find
+    them there. A failure only leaves them shown as numbers.
+    """
+    from analysis.interactions import referenced_ids
+    try:
+        # Counting may need to read the dumps; keep it off the event loop.
+        ids = await asyncio.to_thread(referenced_ids, folder)
+        _, missing = entity_cache.lookup(ids)
+        if not missing:
+            return
+        client = await service.connect()
+        found, failed = await entity_cache.fetch_usernames(client, missing)
+        entity_cache.store(found, failed)
+        print(f"[+] Usernames resolved: {len(found)} of {len(missing)}.")
+    except Exception as e:
+        print(f"[!] Usernames not resolved: {e}")
 
 
-def fetch_user_messages_from_multiple_chats(user_username, chat_usernames: list, limit=500000):
+def fetch_user_messages_from_chat(user_username, chat_username, limit=500000, incremental=True):
     async def run():
-        await client.start()
         user = await _get_user_by_username(user_username)
         if not user:
             print("User not found.")
             return
 
-        username = user.username.lstrip("@") if user.username else None
-        folder_name = username or str(user.id)
+        folder_name = _folder_name(user)
         os.makedirs("data/" + folder_name, exist_ok=True)
-        total_messages = 0
-        total_chats = len(chat_usernames)
-        total_start = time.perf_counter()
-
-        for i, chat_username in enumerate(chat_usernames, 1):
-            print(f"\n[{i}/{total_chats}] [{datetime.now().strftime('%H:%M:%S')}] Processing @{chat_username}...")
-            start = time.perf_counter()
-            messages = []
-            try:
-                async for message in client.iter_messages(chat_username, limit=limit, reverse=True):
-                    if message.from_id and isinstance(message.from_id, PeerUser):
-                        messages.append(_serialize_message(message))
+        count = await _collect_chat_with_retry(f"data/{folder_name}", chat_username, limit, incremental)
+        await resolve_referenced_users(f"data/{folder_name}")
 
-                with open(f"data/{folder_name}/messages_{chat_username}.json", "w", encoding="utf-8") as f:
-                    json.dump(messages, f, indent=4, ensure_ascii=False)
+        print(f"[+] {'New' if incremental else 'Total'} messages: {count} in @{chat_username}")
+    _run(run)
 
-                duration = time.perf_counter() - start
-                print(f"[+] @{chat_username}: {len(messages)} messages saved in {duration:.2f} sec.")
-                total_messages += len(messages)
-
-            except Exception as e:
-                print(f"[!] Error processing @{chat_username}: {e}")
 
+def fetch_user_messages_from_multiple_chats(user_username, chat_usernames: list, limit=500000, incremental=True,
+                                           concurrency=COLLECT_CONCURRENCY):
+    async def run():
+        total_start = time.perf_counter()
+        result = await collect_user_messages(user_username, chat_usernames, limit, incremental, concurrency)
+        if result is None:
+            return
+        _, counts = result
         total_duration = time.perf_counter() - total_start
-        print(f"\n Completed: {total_chats} chats, {total_messages} messages in {total_duration:.2f} sec.")
-        await client.disconnect()
-
-    asyncio.run(run())
+        print(f"\n Completed: {len(chat_usernames)} chats, {sum(counts.values())} messages in {total_duration:.2f} sec.")
+    _run(run)
@@ -0,0 +1,313 @@
+"""
+SQLite message warehouse.
+
+Collected chat dumps are ingested into indexed tables keyed by
+(chat_id, message_id), so message ids of different chats never collide
+and cross-chat filtering and aggregation can run in SQL. The chat dumps
+stay the source of truth; ingestion is incremental and can be re-run at
+any time:
+
+    python src/warehouse.py import [data_dir]
+
+Message text is also indexed in an FTS5 table kept in sync by triggers,
+so every ingest updates the full-text index as well.
+"""
+import os
+import re
+import sys
+import json
+import sqlite3
+from contextlib import closing
+
+from storage import (chat_name, dump_generation, index_record, is_line_delimited, iter_new_lines, message_files,
+                     read_messages, user_folders)
+
+WAREHOUSE_DB = os.path.join("data", "warehouse.db")
+INSERT_BATCH = 5000
+SEARCH_PAGE_SIZE = 20
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS chats (
+    chat_id INTEGER PRIMARY KEY,
+    username TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS messages (
+    rowid INTEGER PRIMARY KEY,
+    chat_id INTEGER NOT NULL REFERENCES chats(chat_id),
+    message_id INTEGER NOT NULL,
+    sender_id INTEGER,
+    date INTEGER,
+    reply_to INTEGER,
+    text TEXT,
+    media_type TEXT,
+    entities TEXT,
+    UNIQUE (chat_id, message_id)
+);
+CREATE INDEX IF NOT EXISTS idx_messages_sender ON messages(sender_id, date);
+CREATE INDEX IF NOT EXISTS idx_messages_date ON messages(date);
+CREATE INDEX IF NOT EXISTS idx_messages_reply ON messages(chat_id, reply_to);
+CREATE TABLE IF NOT EXISTS targets (
+    target TEXT NOT NULL,
+    chat_id INTEGER NOT NULL REFERENCES chats(chat_id),
+    PRIMARY KEY (target, chat_id)
+);
+CREATE TABLE IF NOT EXISTS ingested (
+    path TEXT PRIMARY KEY,
+    bytes INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    generation INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+# unicode61 folds case for Cyrillic as well as Latin. Diacritics are kept:
+# folding them would turn "й" into "и". Prefix indexes make "встреч*"
+# (any inflection of a Russian stem) as cheap as a whole-word query.
+_FTS_SCHEMA = """
+CREATE VIRTUAL TABLE messages_fts USING fts5(
+    text, content='messages', content_rowid='rowid',
+    tokenize='unicode61 remove_diacritics 0', prefix='2 3'
+);
+CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts (rowid, text) VALUES (new.rowid, new.text);
+END;
+CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', old.rowid, old.text);
+END;
+CREATE TRIGGER messages_fts_update AFTER UPDATE OF text ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', old.rowid, old.text);
+    INSERT INTO messages_fts (rowid, text) VALUES (new.rowid, new.text);
+END;
+INSERT INTO messages_fts (messages_fts) VALUES ('rebuild');
+"""
+
+_UPSERT = """
+INSERT INTO messages (chat_id, message_id, sender_id, date, reply_to, text, media_type, entities)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (chat_id, message_id) DO UPDATE SET
+    sender_id = excluded.sender_id, date = excluded.date, reply_to = excluded.reply_to,
+    text = excluded.text, media_type = excluded.media_type, entities = excluded.entities
+"""
+
+
+def connect(db_path=WAREHOUSE_DB):
+    os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(_SCHEMA)
+    if "generation" not in {row[1] for row in conn.execute("PRAGMA table_info(ingested)")}:
+        # Created before dumps had generations.
+        with conn:
+            conn.execute("ALTER TABLE ingested ADD COLUMN generation INTEGER NOT NULL DEFAULT 0")
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").fetchone():
+        # New database, or one created before full-text search existed.
+        with conn:
+            conn.executescript(_FTS_SCHEMA)
+    return conn
+
+
+def chat_id(conn, username):
+    conn.execute("INSERT OR IGNORE INTO chats (username) VALUES (?)", (username,))
+    return conn.execute("SELECT chat_id FROM chats WHERE username = ?", (username,)).fetchone()[0]
+
+
+def _row(cid, msg):
+    date, sender, mid, reply_to = index_record(msg)
+    entities = msg.get("entities")
+    return (cid, mid, sender or None, date or None, reply_to or None, msg.get("text"),
+            msg.get("media_type"), json.dumps(entities, ensure_ascii=False) if entities else None)
+
+
+def ingest_file(conn, target, path):
+    """
+    Bring the warehouse up to date with one chat dump of `target`.
+    Line-delimited dumps are read from where the previous ingest stopped;
+    a legacy .json dump is re-read only if it changed. A dump rewritten
+    from scratch (a new generation, see storage.dump_generation) replaces
+    the chat's rows. A dump of the shared store is ingested once and linked
+    to every target that covers it. Returns the number of messages upserted.
+    """
+    st = os.stat(path)
+    key = os.path.abspath(path)
+    chat = chat_name(path)
+    generation = dump_generation(path) if is_line_delimited(path) else 0
+    with conn:
+        cid = chat_id(conn, chat)
+        conn.execute("INSERT OR IGNORE INTO targets (target, chat_id) VALUES (?, ?)", (target, cid))
+    state = conn.execute("SELECT bytes, mtime_ns, count, generation FROM ingested WHERE path = ?",
+                         (key,)).fetchone()
+    if state and state[3] != generation:
+        # Edited and deleted messages of the old generation must not survive.
+        stale = [p for (p,) in conn.execute("SELECT path FROM ingested") if chat_name(p) == chat]
+        with conn:
+            conn.execute("DELETE FROM messages WHERE chat_id = ?", (cid,))
+            conn.executemany("DELETE FROM ingested WHERE path = ?", [(p,) for p in stale])
+        state = None
+    if state and state[0] == st.st_size and state[1] == st.st_mtime_ns:
+        return 0
+
+    start, count = 0, 0
+    if is_line_delimited(path) and state and state[0] <= st.st_size:
+        start, count = state[0], state[2]
+        stream = iter_new_lines(path, start)
+    elif is_line_delimited(path):
+        stream = iter_new_lines(path, 0)
+    else:
+        stream = ((msg, st.st_size) for msg in read_messages(path))
+
+    new = 0
+    batch = []
+    end = start
+    for msg, end in stream:
+        batch.append(_row(cid, msg))
+        if len(batch) >= INSERT_BATCH:
+            with conn:
+                conn.executemany(_UPSERT, batch)
+            new += len(batch)
+            batch = []
+    with conn:
+        conn.executemany(_UPSERT, batch)
+        new += len(batch)
+        conn.execute(
+            "INSERT OR REPLACE INTO ingested (path, bytes, mtime_ns, count, generation) VALUES (?, ?, ?, ?, ?)",
+            (key, end if is_line_delimited(path) else st.st_size, st.st_mtime_ns, count + new, generation)
+        )
+    return new
+
+
+def ingest_folder(user_folder, db_path=WAREHOUSE_DB):
+    target = os.path.basename(os.path.normpath(user_folder))
+    with closing(connect(db_path)) as conn:
+        return sum(ingest_file(conn, target, path) for path in message_files(user_folder))
+
+
+def import_data(data_dir="data", db_path=WAREHOUSE_DB):
+    """Ingest every user folder under data_dir. Returns {target: messages upserted}."""
+    return {name: ingest_folder(os.path.join(data_dir, name), db_path) for name in user_folders(data_dir)}
+
+
+def _filters(target=None, chats=None, since=None, until=None, sender=None, alias="m"):
+    where, args = [], []
+    if target is not None:
+        where.append(f"{alias}.chat_id IN (SELECT chat_id FROM targets WHERE target = ?)")
+        args.append(target)
+    if chats:
+        where.append(f"{alias}.chat_id IN (SELECT chat_id FROM chats WHERE username IN ({','.join('?' * len(chats))}))")
+        args += list(chats)
+    if since is not None:
+        where.append(f"{alias}.date >= ?")
+        args.append(int(since))
+    if until is not None:
+        where.append(f"{alias}.date < ?")
+        args.append(int(until))
+    if sender is not None:
+        where.append(f"{alias}.sender_id = ?")
+        args.append(int(sender))
+    return (" AND ".join(where) or "1"), args
+
+
+def message_texts(target=None, chats=None, since=None, until=None, sender=None, db_path=WAREHOUSE_DB):
+    """Stream the non-empty texts of the matching messages in collection order."""
+    where, args = _filters(target, chats, since, until, sender)
+    with closing(connect(db_path)) as conn:
+        for (text,) in conn.execute(
+                f"SELECT m.text FROM messages m WHERE {where} AND m.text IS NOT NULL ORDER BY m.rowid", args):
+            yield text
+
+
+def message_entities(target=None, chats=None, since=None, until=None, sender=None, db_path=WAREHOUSE_DB):
+    """
+    Stream {"date", "text", "entities"} of the matching messages that have
+    entities, in collection order. Messages without entities whose text has
+    an "@" come too, with entities None: legacy dumps did not keep them.
+    """
+    where, args = _filters(target, chats, since, until, sender)
+    with closing(connect(db_path)) as conn:
+        for date, text, entities in conn.execute(
+                f"SELECT m.date, m.text, m.entities FROM messages m "
+                f"WHERE {where} AND (m.entities IS NOT NULL OR m.text LIKE '%@%') ORDER BY m.rowid", args):
+            yield {"date": date, "text": text, "entities": json.loads(entities) if entities else None}
+
+
+def reply_pairs(target=None, user_id=None, chats=None, since=None, until=None, db_path=WAREHOUSE_DB):
+    """
+    [((from_id, to_id), count)] for replies between different senders,
+    most frequent first. Replies are matched within their own chat. With
+    user_id only pairs involving that user are returned.
+    """
+    where, args = _filters(target, chats, since, until)
+    if user_id is not None:
+        where += " AND (m.sender_id = ? OR p.sender_id = ?)"
+        args += [user_id, user_id]
+    with closing(connect(db_path)) as conn:
+        rows = conn.execute(f"""
+            SELECT m.sender_id, p.sender_id, COUNT(*) AS n
+            FROM messages m
+            JOIN messages p ON p.chat_id = m.chat_id AND p.message_id = m.reply_to
+            WHERE {where} AND m.sender_id IS NOT NULL AND p.sender_id IS NOT NULL
+                AND m.sender_id != p.sender_id
+            GROUP BY m.sender_id, p.sender_id
+            ORDER BY n DESC, MIN(m.rowid)
+        """, args).fetchall()
+    return [((a, b), n) for a, b, n in rows]
+
+
+def _match_query(query):
+    """
+    Turn free text into an FTS5 query: every word must occur, a trailing *
+    matches by prefix. Quoting each term keeps FTS5 operators and
+    punctuation in user input from being parsed as query syntax.
+    """
+    terms = []
+    for term in query.split():
+        prefix = term.endswith("*")
+        term = term.strip("*").replace('"', "")
+        if re.search(r"\w", term):
+            terms.append(f'"{term}"' + ("*" if prefix else ""))
+    return " ".join(terms)
+
+
+def search(query, target=None, chats=None, sender=None, since=None, until=None,
+           page=1, per_page=SEARCH_PAGE_SIZE, marks=("[", "]"), db_path=WAREHOUSE_DB):
+    """
+    Full-text search, best matches first. Returns (total, rows) where rows
+    is one page of dicts with chat, message_id, sender_id, date and a
+    snippet whose matched terms are wrapped in `marks`.
+    """
+    match = _match_query(query)
+    if not match or not os.path.exists(db_path):
+        return 0, []
+    where, args = _filters(target, chats, since, until, sender)
+    # CROSS JOIN pins the full-text match as the outer loop; otherwise the
+    # planner may scan a filter index and re-run the match per row.
+    sql = f"""
+        FROM messages_fts f
+        CROSS JOIN messages m ON m.rowid = f.rowid
+        JOIN chats c ON c.chat_id = m.chat_id
+        WHERE messages_fts MATCH ? AND {where}
+    """
+    with closing(connect(db_path)) as conn:
+        total = conn.execute(f"SELECT COUNT(*) {sql}", [match] + args).fetchone()[0]
+        rows = conn.execute(f"""
+            SELECT c.username, m.message_id, m.sender_id, m.date,
+                   snippet(messages_fts, 0, ?, ?, '…', 16)
+            {sql}
+            ORDER BY f.rank
+            LIMIT ? OFFSET ?
+        """, list(marks) + [match] + args + [per_page, (max(page, 1) - 1) * per_page]).fetchall()
+    keys = ("chat", "message_id", "sender_id", "date", "snippet")
+    return total, [dict(zip(keys, row)) for row in rows]
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] != "import":
+        print("Usage: python src/warehouse.py import [data_dir]")
+        return
+    data_dir = sys.argv[2] if len(sys.argv) > 2 else "data"
+    for target, count in import_data(data_dir, os.path.join(data_dir, "warehouse.db")).items():
+        print(f"[+] {target}: {count} messages imported")
+
+
+if __name__ == "__main__":
+    main()